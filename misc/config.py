@@ -64,13 +64,23 @@ class ExperimentConfig(BaseConfig):
         self._config_as_obj['agents'].sort(key=itemgetter('algorithm_id'), reverse=False)
 
     def get_env_shapes(self):
-        observation_shapes = [(self._config.env.obs_size,)]
-        state_shapes = [(
-            self._config.env.history_length,
-            self._config.env.obs_size,)]
+        observation_parts = self._config_as_obj['env'].get('observation_parts')
+        if observation_parts is None:
+            observation_shapes = [(self._config.env.obs_size,)]
+        else:
+            observation_shapes = [tuple(part['shape']) for part in observation_parts]
+        state_shapes = [
+            (self._config.env.history_length,) + shape
+            for shape in observation_shapes]
         action_size = self._config.env.action_size
         return observation_shapes, state_shapes, action_size
 
+    def get_observation_dtypes(self):
+        observation_parts = self._config_as_obj['env'].get('observation_parts')
+        if observation_parts is None:
+            return ['float32']
+        return [part.get('dtype', 'float32') for part in observation_parts]
+
     def is_ensemble(self):
         return False
 
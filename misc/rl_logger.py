@@ -91,6 +91,14 @@ class RLServerLogger:
     def log_buffer_size(self, buffer_size, step_index):
         self._logger.add_scalar('buffer_size', buffer_size, step_index)
 
+    def log_memory(self, memory_usage):
+        for key, value in memory_usage.items():
+            self._logger.add_scalar('memory_mb_' + key, value / 2 ** 20, 0)
+
+    def log_ingest(self, ingest_stats, step_index):
+        for key, value in ingest_stats.items():
+            self._logger.add_scalar('ingest_' + key, value, step_index)
+
     def log_train(self, train_info, step_index):
         if isinstance(train_info, dict):
             for key, value in train_info.items():
@@ -1,20 +1,33 @@
 import numpy as np
 
+from rl_server.server.storage_codecs import Float32Codec, RawCodec
+
 
 class AgentBuffer:
 
-    def __init__(self, capacity, observation_shapes, action_size):
+    def __init__(self, capacity, observation_shapes, action_size,
+                 observation_codecs=None, action_codec=None,
+                 recurrent_state_size=None):
         self.size = capacity
         self.num_parts = len(observation_shapes)
         self.obs_shapes = observation_shapes
         self.act_shape = (action_size,)
+        # the same compact storage as on the server, so the agent acts
+        # on exactly the observations the algorithm is trained on
+        self.obs_codecs = observation_codecs or [Float32Codec() for _ in range(self.num_parts)]
+        self.act_codec = action_codec or Float32Codec()
 
         self.observations = []
         for part_id in range(self.num_parts):
-            self.observations.append(np.empty((self.size, ) + self.obs_shapes[part_id], dtype=np.float32))
-        self.actions = np.empty((self.size, ) + self.act_shape, dtype=np.float32)
+            self.observations.append(np.empty(
+                (self.size, ) + self.obs_shapes[part_id], dtype=self.obs_codecs[part_id].dtype))
+        self.actions = np.empty((self.size, ) + self.act_shape, dtype=self.act_codec.dtype)
         self.rewards = np.empty((self.size, ), dtype=np.float32)
         self.dones = np.empty((self.size, ), dtype=np.bool)
+        # recurrent state of the agent before it processed every observation
+        self.recurrent_states = None
+        if recurrent_state_size is not None:
+            self.recurrent_states = np.zeros((self.size, recurrent_state_size), dtype=np.float32)
         self.inited = False
 
     def is_inited(self):
@@ -22,7 +35,7 @@ class AgentBuffer:
 
     def push_init_observation(self, obs):
         for part_id in range(self.num_parts):
-            self.observations[part_id][0] = obs[part_id]
+            self.observations[part_id][0] = self.obs_codecs[part_id].encode(obs[part_id])
         self.pointer = 0
         self.inited = True
 
@@ -31,18 +44,21 @@ class AgentBuffer:
         for part_id in range(self.num_parts):
             s = np.zeros((history_len, ) + self.obs_shapes[part_id], dtype=np.float32)
             indices = np.arange(max(0, self.pointer-history_len+1), self.pointer+1)
-            s[-len(indices):] = self.observations[part_id][indices]
+            s[-len(indices):] = self.obs_codecs[part_id].decode(self.observations[part_id][indices])
             state.append(s)
         return state
 
-    def push_transition(self, transition):
+    def push_transition(self, transition, recurrent_state=None):
         """ transition = [next_obs, action, reward, done]
             next_obs = [next_obs_part_1, ..., next_obs_part_n]
+            recurrent_state is the state the action was computed with
         """
+        if recurrent_state is not None:
+            self.recurrent_states[self.pointer] = recurrent_state
         next_obs, action, reward, done = transition
         for part_id in range(self.num_parts):
-            self.observations[part_id][self.pointer+1] = next_obs[part_id]
-        self.actions[self.pointer] = action
+            self.observations[part_id][self.pointer+1] = self.obs_codecs[part_id].encode(next_obs[part_id])
+        self.actions[self.pointer] = self.act_codec.encode(action)
         self.rewards[self.pointer] = reward
         self.dones[self.pointer] = done
         self.pointer += 1
@@ -51,8 +67,14 @@ class AgentBuffer:
         indices = np.arange(self.pointer)
         observations = []
         for part_id in range(self.num_parts):
-            observations.append(self.observations[part_id][indices])
-        actions = self.actions[indices]
+            if isinstance(self.obs_codecs[part_id], RawCodec):
+                # parts of native dtype (e.g. uint8 images) are sent as is
+                observations.append(self.observations[part_id][indices])
+            else:
+                observations.append(self.obs_codecs[part_id].decode(self.observations[part_id][indices]))
+        actions = self.act_codec.decode(self.actions[indices])
         rewards = self.rewards[indices]
         dones = self.dones[indices]
+        if self.recurrent_states is not None:
+            return [observations, actions, rewards, dones, self.recurrent_states[indices]]
         return [observations, actions, rewards, dones]
@@ -0,0 +1,83 @@
+import socket
+import struct
+import asyncio
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .rl_server_api import RLServerAPI
+from .serialization import serialize, deserialize
+
+
+class AsyncRLServerAPI(RLServerAPI):
+
+    def __init__(self, num_clients, observation_shapes, state_shapes,
+                 ip_address="0.0.0.0", init_port=8777, network_timeout=120,
+                 num_workers=4):
+        """ RL Server API which serves all clients on the single port
+            init_port with one asyncio event loop. Messages are framed as
+            by TCPServer (int32 length + serialized request), so RLClient
+            works as is. Clients may start with the "hello" request to
+            tell their id (see RLClient client_id), clients without it get
+            ids from num_clients on in the order of connection. Requests are decoded and handled
+            (episode decode, weights serialization) in the thread pool.
+
+        Parameters
+        ----------
+        num_clients: int
+            expected number of clients, more can connect
+        num_workers: int
+            number of threads which handle requests
+        """
+        super().__init__(
+            num_clients, observation_shapes, state_shapes,
+            ip_address, init_port, network_timeout)
+        self._executor = ThreadPoolExecutor(num_workers)
+        # ids below num_clients are told by the clients with "hello"
+        self._client_ids = itertools.count(num_clients)
+        self._client_ids_lock = threading.Lock()
+
+    def start_server(self):
+        thread = threading.Thread(target=asyncio.run, args=(self._serve(), ), daemon=True)
+        thread.start()
+
+    async def _serve(self):
+        server = await asyncio.start_server(
+            self._serve_client, self._ip_address, self._init_port)
+        print("--- rl server api is listening on port {}".format(self._init_port))
+        async with server:
+            await server.serve_forever()
+
+    async def _serve_client(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        loop = asyncio.get_running_loop()
+        client_id = None
+        try:
+            while True:
+                # clients may be idle for long, only messages have the timeout
+                header = await reader.readexactly(4)
+                length = struct.unpack("<L", header)[0]
+                request = await asyncio.wait_for(reader.readexactly(length), self._timeout)
+                response, client_id = await loop.run_in_executor(
+                    self._executor, self._handle_request, request, client_id)
+                writer.write(struct.pack("<L", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print("--- tcp connection of client {} closed {}".format(client_id, e))
+        except asyncio.TimeoutError:
+            print("--- tcp connection of client {} timed out".format(client_id))
+        finally:
+            writer.close()
+
+    def _handle_request(self, request, client_id):
+        """ serialized response and id of the client of the connection
+        """
+        req = deserialize(request)
+        if req["method"] == "hello":
+            client_id = req["client_id"]
+        elif client_id is None:
+            with self._client_ids_lock:
+                client_id = next(self._client_ids)
+        return serialize(self.process_request(req, client_id)), client_id
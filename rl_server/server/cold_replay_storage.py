@@ -0,0 +1,171 @@
+import os
+import glob
+import random
+from threading import Lock, Thread
+
+import numpy as np
+
+from rl_server.server.server_replay_buffer import ServerBuffer, batch_rows
+
+
+class ColdStorage:
+
+    def __init__(self, path, fraction=0.25, segment_size=65536,
+                 max_segments=None, cache_segments=4, refresh_period=100):
+        """ Cold tier of the ServerBuffer: transitions evicted from the
+            in-memory ring are written to disk in large compressed segments
+            (snapshots of ServerBuffer of segment_size transitions) and a
+            fraction of every sampled batch is taken from a small cache of
+            segments, which is refreshed in the background.
+
+        Parameters
+        ----------
+        path: str
+            folder of the segment files, segments of previous runs are reused
+        fraction: float
+            fraction of the batch sampled from the cold tier
+        segment_size: int
+            number of transitions in one segment
+        max_segments: int
+            number of segments kept on disk, the oldest ones are deleted
+            (all are kept by default)
+        cache_segments: int
+            number of segments kept in memory for sampling
+        refresh_period: int
+            number of sampled batches after which one more segment is
+            loaded to the full cache in place of the oldest one
+        """
+        self.path = path
+        self.fraction = fraction
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.cache_segments = cache_segments
+        self.refresh_period = refresh_period
+
+        self._lock = Lock()
+        self._segments = []
+        self._cache = []
+        self._write_thread = None
+        self._load_thread = None
+        self._staging = None
+        self._num_samples = 0
+
+    def attach(self, buffer):
+        """ take parameters of segments from the hot buffer
+        """
+
+        def create_segment():
+            return ServerBuffer(
+                self.segment_size, buffer.obs_shapes, buffer.act_shape[0],
+                observation_codecs=buffer.obs_codecs,
+                action_codec=buffer.act_codec,
+                recurrent_state_size=buffer.recurrent_state_size)
+
+        self._create_segment = create_segment
+        self._staging = create_segment()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._segments = sorted(glob.glob(os.path.join(self.path, "segment_*.buffer")))
+        self._num_written = 0
+        if len(self._segments) > 0:
+            self._num_written = int(self._segments[-1][-15:-7]) + 1
+        print("--- cold replay storage {} with {} segments".format(
+            self.path, len(self._segments)))
+
+    def get_num_in_storage(self):
+        return len(self._segments) * self.segment_size
+
+    def evict(self, buffer, indices):
+        """ copy transitions which are going to be overwritten
+            in the hot buffer, indices are in chronological order
+        """
+        while len(indices) > 0:
+            staging = self._staging
+            num = min(len(indices), self.segment_size - staging.num_in_buffer)
+            dst = np.arange(staging.num_in_buffer, staging.num_in_buffer + num)
+            for (_, src_array), (_, dst_array) in zip(
+                    buffer._stored_arrays(), staging._stored_arrays()):
+                dst_array[dst] = src_array[indices[:num]]
+            staging.num_in_buffer += num
+            staging.stored_in_buffer += num
+            indices = indices[num:]
+            if staging.num_in_buffer == self.segment_size:
+                self._write_staging()
+
+    def _write_staging(self):
+        if self._write_thread is not None:
+            self._write_thread.join()
+        path = os.path.join(self.path, "segment_{:08d}.buffer".format(self._num_written))
+        self._num_written += 1
+        self._write_thread = Thread(target=self._write_segment, args=(self._staging, path))
+        self._write_thread.start()
+        self._staging = self._create_segment()
+
+    def _write_segment(self, segment, path):
+        segment.save(path, compress=True)
+        with self._lock:
+            self._segments.append(path)
+            if self.max_segments is not None:
+                while len(self._segments) > self.max_segments:
+                    os.remove(self._segments.pop(0))
+
+    def _load_segment(self, path):
+        segment = self._create_segment()
+        try:
+            segment.load(path, verbose=False)
+        except FileNotFoundError:
+            # deleted as one of the oldest
+            return
+        with self._lock:
+            self._cache.append(segment)
+            if len(self._cache) > self.cache_segments:
+                self._cache.pop(0)
+
+    def _refresh_cache(self):
+        """ load one more random segment in the background every
+            refresh_period batches, it replaces the oldest segment of the cache
+        """
+        self._num_samples += 1
+        if len(self._cache) >= self.cache_segments and self._num_samples % self.refresh_period != 0:
+            return
+        if self._load_thread is not None and self._load_thread.is_alive():
+            return
+        with self._lock:
+            if len(self._segments) == 0:
+                return
+            path = random.choice(self._segments)
+        self._load_thread = Thread(target=self._load_segment, args=(path, ))
+        self._load_thread.start()
+
+    def get_sample_size(self, batch_size):
+        """ number of transitions of the batch taken from the cold tier,
+            0 until the first segment is in the cache
+        """
+        self._refresh_cache()
+        if len(self._cache) == 0:
+            return 0
+        return int(round(self.fraction * batch_size))
+
+    def sample(self, batch_size, history_len, n_step, gamma, window, out):
+        """ fill out batch with transitions of the cached segments,
+            segment is a slice of the ring which may end within an episode,
+            so its last n_step transitions are not sampled: their next
+            states and returns are in the next segment
+        """
+        with self._lock:
+            cache = list(self._cache)
+        counts = np.bincount(np.random.randint(len(cache), size=batch_size), minlength=len(cache))
+        ends = np.cumsum(counts)
+        for segment, start, end in zip(cache, ends - counts, ends):
+            if start == end:
+                continue
+            indices = np.random.randint(segment.num_in_buffer - n_step, size=end - start)
+            segment.get_batch(
+                end - start, history_len, n_step, gamma, indices, window,
+                out=batch_rows(out, start, end))
+
+    def close(self):
+        for thread in (self._write_thread, self._load_thread):
+            if thread is not None:
+                thread.join()
+
@@ -0,0 +1,189 @@
+import time
+from threading import Lock
+
+import numpy as np
+
+
+def merge_transitions(episode, keep):
+    """ Keep the transitions of the episode selected by the mask,
+        every dropped transition is merged into the previous kept one:
+        its reward is added and its done is or-ed, so the terminal
+        transition and the return of the episode are preserved. This is
+        a frame skip approximation: rewards of merged steps are not
+        discounted and the kept transition still bootstraps with one
+        step of gamma, so gamma applies per kept step.
+
+    Parameters
+    ----------
+    episode: list [observations, actions, rewards, dones(, recurrent_states)]
+    keep: np.array of bool of the episode length
+
+    Returns
+    -------
+    episode of the same structure with keep.sum() transitions
+    """
+    observations, actions, rewards, dones = episode[:4]
+    keep = np.array(keep, dtype=np.bool_)
+    keep[0] = True
+    if keep.all():
+        return episode
+    groups = np.cumsum(keep) - 1
+    num_kept = groups[-1] + 1
+    merged = [
+        [obs[keep] for obs in observations],
+        np.asarray(actions)[keep],
+        np.bincount(groups, weights=rewards, minlength=num_kept).astype(np.float32),
+        np.bincount(groups, weights=dones, minlength=num_kept) > 0]
+    if len(episode) > 4:
+        merged.append(np.asarray(episode[4])[keep])
+    return merged
+
+
+class StrideFilter:
+
+    def __init__(self, stride=2):
+        """ Keep every stride-th transition of the episode.
+        """
+        self.stride = stride
+
+    def __call__(self, episode, agent_id):
+        return merge_transitions(episode, np.arange(len(episode[2])) % self.stride == 0)
+
+
+class NearDuplicateFilter:
+
+    def __init__(self, threshold=1e-3):
+        """ Drop transitions whose observation differs from the last kept
+            one by less than threshold in every feature of every part
+            (max-norm of the difference), so a slow drift is not merged
+            into one transition.
+        """
+        self.threshold = threshold
+
+    def __call__(self, episode, agent_id):
+        num_transitions = len(episode[2])
+        if num_transitions < 2:
+            return episode
+        # features of all parts, one row per step
+        observations = np.concatenate([
+            np.asarray(obs, dtype=np.float32).reshape(num_transitions, -1)
+            for obs in episode[0]], axis=1)
+        keep = np.zeros(num_transitions, dtype=np.bool_)
+        reference = observations[0]
+        for i in range(1, num_transitions):
+            if np.abs(observations[i] - reference).max() > self.threshold:
+                keep[i] = True
+                reference = observations[i]
+        return merge_transitions(episode, keep)
+
+
+class AgentRateFilter:
+
+    def __init__(self, max_rate, burst=10.):
+        """ Cap the insert rate of every agent with a token bucket,
+            episodes are dropped as a whole when the agent is over budget.
+
+        Parameters
+        ----------
+        max_rate: float
+            transitions per second accepted from one agent
+        burst: float
+            seconds of max_rate which may be accepted at once
+        """
+        self.max_rate = max_rate
+        self.capacity = max_rate * burst
+        self._buckets = {}
+        self._lock = Lock()
+
+    def __call__(self, episode, agent_id):
+        num_transitions = len(episode[2])
+        now = time.time()
+        with self._lock:
+            tokens, last_time = self._buckets.get(agent_id, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last_time) * self.max_rate)
+            accepted = tokens >= min(num_transitions, self.capacity)
+            if accepted:
+                tokens -= num_transitions
+            self._buckets[agent_id] = (tokens, now)
+        return episode if accepted else None
+
+
+class IngestPipeline:
+
+    def __init__(self, filters):
+        """ Filters applied in order to every incoming episode before
+            it is pushed to the replay buffer. Filter is a callable
+            (episode, agent_id) -> episode or None if the whole episode
+            is dropped.
+        """
+        self.filters = filters
+        self._lock = Lock()
+        self._start_time = time.time()
+        self._filter_time = 0.
+        self._received = 0
+        self._stored = 0
+        self._dropped_episodes = 0
+        self._dropped = [0] * len(filters)
+
+    def __call__(self, episode, agent_id=0):
+        start_time = time.time()
+        num_received = len(episode[2])
+        dropped = []
+        for f in self.filters:
+            num_before = len(episode[2])
+            episode = f(episode, agent_id)
+            if episode is None:
+                dropped.append(num_before)
+                break
+            dropped.append(num_before - len(episode[2]))
+        with self._lock:
+            self._filter_time += time.time() - start_time
+            self._received += num_received
+            for i, num_dropped in enumerate(dropped):
+                self._dropped[i] += num_dropped
+            if episode is None:
+                self._dropped_episodes += 1
+            else:
+                self._stored += len(episode[2])
+        return episode
+
+    def get_stats(self):
+        """ transitions received and stored, dropped by every filter,
+            rate of incoming transitions and throughput of the filters
+        """
+        with self._lock:
+            stats = {
+                'received': self._received,
+                'stored': self._stored,
+                'dropped_episodes': self._dropped_episodes,
+                'received_per_second': self._received / max(time.time() - self._start_time, 1e-6),
+                'filtered_per_second': self._received / max(self._filter_time, 1e-6)}
+            # filters of the same type are told apart by their position
+            for i, (f, num_dropped) in enumerate(zip(self.filters, self._dropped)):
+                stats['dropped_{}_{}'.format(i, type(f).__name__)] = num_dropped
+        return stats
+
+
+def create_ingest_filters(params):
+    """ Create pipeline from config parameters, list of filters
+
+        type: stride | near_duplicate | rate_cap
+        stride: keep every stride-th transition (stride)
+        threshold: max-norm of the observation change (near_duplicate)
+        max_rate, burst: transitions per second per agent (rate_cap)
+    """
+    if not params:
+        return None
+    filters = []
+    for filter_params in params:
+        filter_type = filter_params['type']
+        if filter_type == 'stride':
+            filters.append(StrideFilter(filter_params.get('stride', 2)))
+        elif filter_type == 'near_duplicate':
+            filters.append(NearDuplicateFilter(filter_params.get('threshold', 1e-3)))
+        elif filter_type == 'rate_cap':
+            filters.append(AgentRateFilter(
+                filter_params['max_rate'], filter_params.get('burst', 10.)))
+        else:
+            raise NotImplementedError(filter_type)
+    return IngestPipeline(filters)
@@ -1,141 +1,298 @@
-# will be reworked to use with redis
-
 import queue
+import itertools
+from collections import namedtuple
 from time import sleep
 from multiprocessing import Process, Queue, Value
 
 import numpy as np
 
-from rl_server.server.server_replay_buffer import ServerBuffer, Transition
-from rl_server.server.rl_client import episode_to_req
-from rl_server.server.rl_server_api import req_to_episode
-
-
-def np_array_to_str(arr):
-    return {
-        'data': arr.reshape((-1)).tostring(),
-        'shape': arr.shape
-    }
-    
-    
-def str_to_np_array(data, dtype):
-    return np.frombuffer(
-        data['data'],
-        dtype=dtype
-    ).reshape(data['shape'])
-
-
-def batch_to_str(batch):
-    return [
-        np_array_to_str(batch.s),
-        np_array_to_str(batch.a),
-        np_array_to_str(batch.r),
-        np_array_to_str(batch.s_),
-        np_array_to_str(batch.done)
-    ]
-    
-    
-def str_to_batch(batch):
-    return Transition(
-        str_to_np_array(batch[0], np.float32),
-        str_to_np_array(batch[1], np.float32),
-        str_to_np_array(batch[2], np.float32),
-        str_to_np_array(batch[3], np.float32),
-        str_to_np_array(batch[4], np.bool)
-    )
+from rl_server.server.shared_replay_buffer import SharedServerBuffer, shared_array
+
+PriorityInfo = namedtuple("PriorityInfo", ("indices", "is_weights", "generations"))
+_fetcher_ids = itertools.count()
+
+
+class SharedBatchSlots:
+
+    def __init__(self, name, template, num_slots, create=True):
+        """ Ring of preallocated batches in multiprocessing.shared_memory,
+            samplers fill the slots in place and only slot ids are passed
+            between processes.
+
+        Parameters
+        ----------
+        name: str
+            prefix of the shared memory blocks
+        template: Transition or WindowTransition
+            batch whose arrays give shapes and dtypes of the slots
+        num_slots: int
+            number of batches in the ring
+        create: bool
+            True for the trainer which creates the blocks,
+            False for samplers which attach to them
+        """
+        self.name = name
+        self.create = create
+        self.num_slots = num_slots
+        self._batch_type = type(template)
+        self._shared_blocks = []
+        self._fields = []
+        for field_name, field in zip(template._fields, template):
+            # states are given per observation part
+            if isinstance(field, list):
+                self._fields.append([
+                    self._shared_array("{}{}".format(field_name, i), part)
+                    for i, part in enumerate(field)])
+            else:
+                self._fields.append(self._shared_array(field_name, field))
+
+    def _shared_array(self, name, template):
+        array, block = shared_array(
+            "{}_{}".format(self.name, name), (self.num_slots, ) + template.shape,
+            template.dtype, self.create)
+        self._shared_blocks.append(block)
+        return array
+
+    def __getitem__(self, slot):
+        """ batch of the slot, arrays are views of the shared memory
+        """
+        return self._batch_type(*[
+            [part[slot] for part in field] if isinstance(field, list) else field[slot]
+            for field in self._fields])
+
+    def close(self):
+        self._fields = []
+        for block in self._shared_blocks:
+            block.close()
+            if self.create:
+                block.unlink()
+        self._shared_blocks = []
+
+
+def sample_batches_loop(name, buffer_params, batch_params, slots_name, num_slots,
+                        stop, beta, free_slots, ready_slots, td_errors_queue):
+    """ sampler process: attach to the shared buffer and the batch slots,
+        fill every free slot with a new batch and report it as ready,
+        the prioritized sampler also applies td errors sent by the trainer
+    """
+    server_buffer = SharedServerBuffer(name, create=False, **buffer_params)
+    server_buffer.register_n_step(batch_params['n_step'], batch_params['gamma'])
+    template = server_buffer._allocate_batch(
+        batch_params['batch_size'], batch_params['history_len'],
+        batch_params['n_step'], batch_params['window'])[0]
+    slots = SharedBatchSlots(slots_name, template, num_slots, create=False)
+    priority_slots = None
+    if server_buffer.prioritized:
+        priority_slots = SharedBatchSlots(
+            slots_name + "_priority", priority_template(batch_params['batch_size']),
+            num_slots, create=False)
+
+    while stop.value == 0:
+        if priority_slots is not None:
+            while True:
+                try:
+                    indices, td_errors, generations = td_errors_queue.get_nowait()
+                except queue.Empty:
+                    break
+                server_buffer.update_td_errors(indices, td_errors, generations)
+
+        stored_in_buffer = server_buffer.get_stored_in_buffer()
+        if stored_in_buffer <= max(batch_params['start_after'], batch_params['batch_size']):
+            sleep(0.1)
+            continue
+        try:
+            slot = free_slots.get(block=True, timeout=0.1)
+        except queue.Empty:
+            continue
+
+        if priority_slots is None:
+            server_buffer.get_batch(
+                batch_params['batch_size'],
+                batch_params['history_len'],
+                batch_params['n_step'],
+                batch_params['gamma'],
+                window=batch_params['window'],
+                out=slots[slot])
+        else:
+            _, indices, is_weights, generations = server_buffer.get_prioritized_batch(
+                batch_params['batch_size'],
+                history_len=batch_params['history_len'],
+                n_step=batch_params['n_step'],
+                gamma=batch_params['gamma'],
+                priority=batch_params['priority'],
+                beta=beta.value,
+                window=batch_params['window'],
+                out=slots[slot])
+            priority_info = priority_slots[slot]
+            priority_info.indices[:] = indices
+            priority_info.is_weights[:] = is_weights
+            priority_info.generations[:] = generations
+        ready_slots.put(slot)
+
+    slots.close()
+    if priority_slots is not None:
+        priority_slots.close()
+    server_buffer.close()
+
+
+def priority_template(batch_size):
+    return PriorityInfo(
+        np.zeros(batch_size, dtype=np.int64),
+        np.zeros(batch_size, dtype=np.float32),
+        np.zeros(batch_size, dtype=np.int64))
 
 
 class ParallelBatchFetcher:
-    
-    def __init__(self, buffer_size, observation_shapes, action_size, batch_prepare_params):
-        self._buffer_size = buffer_size
-        self._observation_shapes = observation_shapes
-        self._action_size = action_size
-        self._batch_prepare_params = batch_prepare_params
+
+    def __init__(self, server_buffer, batch_prepare_params, num_workers=1,
+                 num_slots=None, prioritized=False, alpha=0.6, rank_sort_period=1000):
+        """ Batches are sampled by num_workers processes. Episodes are
+            pushed to the SharedServerBuffer of the trainer, samplers read
+            it lock-free and write batches directly into a ring of shared
+            memory slots, only slot ids go through the queues.
+
+        Parameters
+        ----------
+        server_buffer: SharedServerBuffer
+            buffer created by the trainer (create=True), n-step returns
+            used by the batches must be registered before start
+        batch_prepare_params: dict
+            batch_size, history_len, n_step, gamma,
+            window (False by default), start_after (5000 by default)
+            number of stored transitions before sampling starts,
+            priority ("proportional" by default) and beta (1.0 by default)
+            of the prioritized batches
+        num_workers: int
+            number of sampler processes, priorities are kept by the sampler,
+            so there is one in the prioritized mode
+        num_slots: int
+            number of batches in the ring, 2 * num_workers + 1 by default
+        prioritized: bool
+            prepare prioritized batches, td errors computed by the trainer
+            are sent back to the sampler with update_td_errors
+        """
+        self._server_buffer = server_buffer
+        self.batch_size = batch_prepare_params['batch_size']
+        self._prioritized = prioritized
+        if self._prioritized and num_workers > 1:
+            print("--- prioritized batches are prepared by one sampler")
+            num_workers = 1
+        self._num_workers = num_workers
+        self._num_slots = num_slots or 2 * num_workers + 1
+        self._buffer_params = dict(
+            capacity=server_buffer.size,
+            observation_shapes=server_buffer.obs_shapes,
+            action_size=server_buffer.act_shape[0],
+            segment_size=server_buffer.segment_size,
+            observation_codecs=server_buffer.obs_codecs,
+            action_codec=server_buffer.act_codec,
+            prioritized=prioritized,
+            alpha=alpha,
+            rank_sort_period=rank_sort_period)
+        self._batch_params = dict(
+            window=False, start_after=5000, priority="proportional", beta=1.0)
+        self._batch_params.update(batch_prepare_params)
+
+        # fetchers are recreated when the batch size changes
+        self._slots_name = "{}_batch{}".format(server_buffer.name, next(_fetcher_ids))
+        template = server_buffer._allocate_batch(
+            self.batch_size, self._batch_params['history_len'],
+            self._batch_params['n_step'], self._batch_params['window'])[0]
+        self._slots = SharedBatchSlots(self._slots_name, template, self._num_slots)
+        self._priority_slots = None
+        if self._prioritized:
+            self._priority_slots = SharedBatchSlots(
+                self._slots_name + "_priority", priority_template(self.batch_size),
+                self._num_slots)
 
         self._stop_batch_loop = Value('i', 0)
-        self._output_batch_queue = Queue(100)
-        self._input_episode_queue = Queue(100)
-        self._stored_in_buffer = Value('i', 0)
-        
+        self._beta = Value('d', self._batch_params['beta'])
+        self._free_slots = Queue()
+        self._ready_slots = Queue()
+        self._td_errors_queue = Queue()
+        for slot in range(self._num_slots):
+            self._free_slots.put(slot)
+        # slot of the batch returned last, it is in use until the next get_batch
+        self._current_slot = None
+        self._workers = []
+
     def start(self):
+        for _ in range(self._num_workers):
+            worker = Process(
+                target=sample_batches_loop,
+                args=(
+                    self._server_buffer.name,
+                    self._buffer_params,
+                    self._batch_params,
+                    self._slots_name,
+                    self._num_slots,
+                    self._stop_batch_loop,
+                    self._beta,
+                    self._free_slots,
+                    self._ready_slots,
+                    self._td_errors_queue
+                ),
+                daemon=True)
+            worker.start()
+            self._workers.append(worker)
 
-        def batch_prepare_loop(
-            buffer_size,
-            observation_shapes,
-            action_size,
-            batch_prepare_params,
-            stop_batch_loop,
-            input_episode_queue,
-            output_batch_queue,
-            stored_in_buffer
-        ):
-            batch_size = batch_prepare_params['batch_size']
-            history_len = batch_prepare_params['history_len']
-            n_step = batch_prepare_params['n_step']
-            gamma = batch_prepare_params['gamma']
-            indices = batch_prepare_params['indices']
-        
-            server_buffer = ServerBuffer(
-                buffer_size,
-                observation_shapes,
-                action_size)
-                
-            print('--- start')
-            while stop_batch_loop.value == 0:
-                # check new episodes to put
-                try:
-                    episode = input_episode_queue.get_nowait()
-                    server_buffer.push_episode(episode)
-                    stored_in_buffer.value = server_buffer.get_stored_in_buffer()
-                except queue.Empty:
-                    pass
-                
-                # fetch new batch
-                if stored_in_buffer.value > 5000:
-                    batch = server_buffer.get_batch(
-                        batch_size,
-                        history_len,
-                        n_step,
-                        gamma,
-                        indices)
-                    batch = batch_to_str(batch)
-                    try:
-                        output_batch_queue.put(batch, block=True, timeout=1.0)
-                    except queue.Full:
-                        pass
-            
-        self._batch_loop_process = Process(
-            target=batch_prepare_loop,
-            args=(
-                self._buffer_size,
-                self._observation_shapes,
-                self._action_size,
-                self._batch_prepare_params,
-                self._stop_batch_loop,
-                self._input_episode_queue,
-                self._output_batch_queue,
-                self._stored_in_buffer
-            ))
-            
-        self._batch_loop_process.start()
-        
     def join(self):
-        self._batch_loop_process.join()
-        
-    def push_episode(self, episode):
-        try:
-            self._input_episode_queue.put(episode, block=True, timeout=1.0)
-        except queue.Full:
-            print('--- cannot store episode, episode queue is full')
-        
-    def get_batch(self):
+        for worker in self._workers:
+            worker.join()
+
+    def stop(self):
+        """ stop samplers and free the batch slots,
+            the buffer stays with the trainer
+        """
+        self._stop_batch_loop.value = 1
+        self.join()
+        self._workers = []
+        self._slots.close()
+        if self._priority_slots is not None:
+            self._priority_slots.close()
+
+    def _next_slot(self, timeout):
+        if self._current_slot is not None:
+            self._free_slots.put(self._current_slot)
+            self._current_slot = None
         try:
-            batch = self._output_batch_queue.get(block=True, timeout=1.0)
-            batch = str_to_batch(batch)
-            return batch
+            self._current_slot = self._ready_slots.get(block=True, timeout=timeout)
         except queue.Empty:
+            pass
+        return self._current_slot
+
+    def get_batch(self, timeout=1.0):
+        """ next prepared batch, its arrays are views of the shared slot
+            and stay valid until the next call of get_batch, None if no
+            batch is ready within timeout
+        """
+        slot = self._next_slot(timeout)
+        if slot is None:
             return None
+        return self._slots[slot]
+
+    def get_prioritized_batch(self, beta, timeout=1.0):
+        """ next prepared batch with indices, importance sampling weights
+            and generations (see ServerBuffer.get_prioritized_batch),
+            beta is used by the batches prepared from now on
+        """
+        self._beta.value = beta
+        slot = self._next_slot(timeout)
+        if slot is None:
+            return None
+        indices, is_weights, generations = self._priority_slots[slot]
+        return self._slots[slot], indices, is_weights, generations
+
+    def update_td_errors(self, indices, td_errors, generations=None):
+        """ send td errors to the sampler which keeps the priorities,
+            arrays are copied as the slot is reused
+        """
+        self._td_errors_queue.put((
+            np.array(indices), np.array(td_errors),
+            None if generations is None else np.array(generations)))
+
+    def push_episode(self, episode):
+        self._server_buffer.push_episode(episode)
 
     def get_stored_in_buffer(self):
-        return self._stored_in_buffer.value
+        return self._server_buffer.get_stored_in_buffer()
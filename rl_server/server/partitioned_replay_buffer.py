@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+
+from rl_server.server.server_replay_buffer import ServerBuffer, BatchPool, batch_rows
+
+
+class PartitionedServerBuffer:
+
+    def __init__(self, capacity, observation_shapes, action_size,
+                 num_partitions, mixing=None, storage_path=None, **buffer_kwargs):
+        """ Replay buffer of the ensemble with one ServerBuffer partition
+            per algorithm_id. Batch consists of the sub-batches of all
+            algorithms one after another, which are split in graph
+            (see create_placeholders_n_algos_with_split).
+
+        Parameters
+        ----------
+        capacity: int
+            maximal number of stored transitions, split evenly between partitions
+        num_partitions: int
+            number of algorithms of the ensemble
+        mixing: np.array of shape (num_partitions, num_partitions)
+            fraction of the sub-batch of algorithm i sampled from the
+            partition j, rows sum to 1, every algorithm samples only
+            the episodes of its own agents by default
+        storage_path: str
+            folder of memory-mapped partitions, partition i is in its subfolder i
+        buffer_kwargs:
+            other parameters of ServerBuffer partitions
+        """
+        self.num_partitions = num_partitions
+        if mixing is None:
+            mixing = np.eye(num_partitions)
+        self.mixing = np.array(mixing, dtype=np.float64)
+        assert self.mixing.shape == (num_partitions, num_partitions)
+        self.mixing /= self.mixing.sum(axis=1, keepdims=True)
+
+        self.partitions = []
+        for i in range(num_partitions):
+            partition_path = None
+            if storage_path is not None:
+                partition_path = os.path.join(storage_path, str(i))
+            self.partitions.append(ServerBuffer(
+                capacity // num_partitions, observation_shapes, action_size,
+                storage_path=partition_path, **buffer_kwargs))
+        self._batch_buffers = BatchPool(self._allocate_batch)
+        self._rng = np.random.default_rng()
+
+    def push_episode(self, episode, partition=0):
+        self.partitions[partition].push_episode(episode)
+
+    def get_stored_in_buffer(self):
+        return sum(partition.get_stored_in_buffer() for partition in self.partitions)
+
+    def get_memory_usage(self):
+        usage = {}
+        for i, partition in enumerate(self.partitions):
+            for name, nbytes in partition.get_memory_usage().items():
+                usage["{}/{}".format(i, name)] = nbytes
+        return usage
+
+    def register_n_step(self, n_step=1, gamma=0.99):
+        for partition in self.partitions:
+            partition.register_n_step(n_step, gamma)
+
+    def register_batch_buffers(self, batch_size, history_len=1, n_step=1,
+                               window=False, num_buffers=2):
+        """ see ServerBuffer.register_batch_buffers,
+            batch_size is the size of the sub-batch of one algorithm
+        """
+        self._batch_buffers.register((batch_size, history_len, n_step, window), num_buffers)
+
+    def _allocate_batch(self, batch_size, history_len, n_step, window):
+        return self.partitions[0]._allocate_batch(
+            self.num_partitions * batch_size, history_len, n_step, window)[0]
+
+    def get_sub_batch_counts(self, batch_size):
+        """ number of transitions which the sub-batch of algorithm i
+            takes from the partition j, empty partitions are skipped
+        """
+        sizes = np.array([partition.num_in_buffer for partition in self.partitions])
+        mixing = self.mixing * (sizes > 0)
+        # algorithms whose partitions are all empty yet sample the others uniformly
+        mixing[mixing.sum(axis=1) == 0] = sizes > 0
+        mixing /= mixing.sum(axis=1, keepdims=True)
+        counts = np.floor(mixing * batch_size).astype(np.int64)
+        rows = np.arange(self.num_partitions)
+        counts[rows, np.argmax(mixing, axis=1)] += batch_size - counts.sum(axis=1)
+        return counts, sizes
+
+    def get_batch(self, batch_size, history_len=1, n_step=1, gamma=0.99,
+                  indices=None, window=False):
+        """ sample the sub-batches of batch_size transitions for all algorithms,
+            indices of all of them are drawn by one generator call and every
+            block is gathered in place into its slice of the batch
+        """
+        assert indices is None, "indices are given per partition"
+        return self._get_batch(batch_size, history_len, n_step, gamma, window)
+
+    def _get_batch(self, batch_size, history_len, n_step, gamma, window, pooled=True):
+        counts, sizes = self.get_sub_batch_counts(batch_size)
+        block_partitions = np.tile(np.arange(self.num_partitions), self.num_partitions)
+        block_counts = counts.ravel()
+        row_sizes = np.repeat(sizes[block_partitions], block_counts)
+        rows = (self._rng.random(len(row_sizes)) * row_sizes).astype(np.int64)
+
+        batch = self._batch_buffers.next((batch_size, history_len, n_step, window), pooled)
+        ends = np.cumsum(block_counts)
+        for partition_id, start, end in zip(block_partitions, ends - block_counts, ends):
+            if start == end:
+                continue
+            self.partitions[partition_id].get_batch(
+                end - start, history_len, n_step, gamma,
+                rows[start:end], window, out=batch_rows(batch, start, end))
+        return batch
+
+    def get_batches(self, num_batches, batch_size, history_len=1, n_step=1,
+                    gamma=0.99, window=False):
+        key = (batch_size, history_len, n_step, window)
+        pooled = self._batch_buffers.can_pool(key, num_batches)
+        return [
+            self._get_batch(batch_size, history_len, n_step, gamma, window, pooled)
+            for _ in range(num_batches)]
+
+    def get_prioritized_batch(self, *args, **kwargs):
+        raise NotImplementedError(
+            "priorities are not supported by the partitioned buffer")
+
+    def flush(self):
+        for partition in self.partitions:
+            partition.flush()
@@ -7,6 +7,7 @@ import numpy as np
 
 from rl_server.server.rl_client import RLClient
 from rl_server.server.agent_replay_buffer import AgentBuffer
+from rl_server.server.storage_codecs import create_storage_codecs
 from misc.common import set_global_seeds, create_if_need
 from misc.rl_logger import RLLogger
 
@@ -82,6 +83,8 @@ class RLAgent:
             self._state_shapes,
             self._action_size
         ) = self._exp_config.get_env_shapes()
+        self._observation_codecs, self._action_codec = create_storage_codecs(
+            self._exp_config, self._observation_shapes, self._action_size)
 
         set_global_seeds(self._seed)
         self._logger = RLLogger(
@@ -93,9 +96,16 @@ class RLAgent:
 
         self._rl_client = None
         if self._checkpoint_path is None:
-            self._rl_client = RLClient(
-                port=self._exp_config.server.client_start_port + self._id
-            )
+            if getattr(self._exp_config.server, 'single_port', False):
+                # all agents share the port of the asyncio server
+                self._rl_client = RLClient(
+                    port=self._exp_config.server.client_start_port,
+                    client_id=self._id
+                )
+            else:
+                self._rl_client = RLClient(
+                    port=self._exp_config.server.client_start_port + self._id
+                )
 
         if self._exp_config.framework == 'tensorflow':
             from rl_server.tensorflow.agent_model_tf import AgentModel
@@ -120,9 +130,18 @@ class RLAgent:
         self._agent_buffer = AgentBuffer(
             buf_capacity,
             self._observation_shapes,
-            self._action_size
+            self._action_size,
+            self._observation_codecs,
+            self._action_codec
         )
-        self._agent_buffer.push_init_observation([first_obs])
+        self._agent_buffer.push_init_observation(self.observation_parts(first_obs))
+
+    def observation_parts(self, obs):
+        """ envs with several observation parts return the list of them
+        """
+        if len(self._observation_shapes) > 1:
+            return list(obs)
+        return [obs]
 
     def init_episode_storage(self):
         storage_path = os.path.join(self._logdir, 'episodes')
@@ -160,7 +179,7 @@ class RLAgent:
         # explore_temp = explore_start_temp
         
         def prepare_state(state):
-            return [np.expand_dims(state, axis=0)]
+            return [np.expand_dims(part, axis=0) for part in state]
 
         while True:
 
@@ -172,7 +191,7 @@ class RLAgent:
                 # obtain current state from the buffer
                 state = self._agent_buffer.get_current_state(
                     history_len=self._history_len
-                )[0]
+                )
 
                 # Bernoulli exploration
                 # action = np.array(self._agent_model.act_batch(prepare_state(state))[0])
@@ -215,7 +234,7 @@ class RLAgent:
 
             next_obs, reward, done, info = self._env.step(env_action)
             action_repeated += 1
-            transition = [[next_obs], action, reward, done]
+            transition = [self.observation_parts(next_obs), action, reward, done]
             self._agent_buffer.push_transition(transition)
 
             n_steps += 1
@@ -225,7 +244,7 @@ class RLAgent:
                 self._logger.log(episode_index, n_steps)
                 episode = self._agent_buffer.get_complete_episode()
                 if self._checkpoint_path is None:
-                    self._rl_client.store_episode(episode)
+                    self._rl_client.store_episode(episode, self._algorithm_id)
 
                 self.fetch_model()
 
@@ -2,7 +2,7 @@ import threading
 
 import numpy as np
 
-from .tcp_client_server import TCPClient
+from .tcp_client_server import TCPClient, TCPConnectionClosedError
 from .serialization import serialize, deserialize
 
 
@@ -30,7 +30,7 @@ def episode_to_req(episode, method="store_episode"):
     """ Create compact serialized representation of the episode
         to pass it as a request.
     """
-    observations, actions, rewards, dones = episode
+    observations, actions, rewards, dones = episode[:4]
     str_obs = obs_to_string(observations)
     str_act = actions.tolist()
     str_rew = rewards.tolist()
@@ -40,6 +40,11 @@ def episode_to_req(episode, method="store_episode"):
                      "actions": str_act,
                      "rewards": str_rew,
                      "dones": str_don}
+    # parts are sent in their native dtype, e.g. uint8 images
+    req["observation_dtypes"] = [np.asarray(obs).dtype.str for obs in observations]
+    if len(episode) > 4:
+        # recurrent states the agent acted with
+        req["recurrent_states"] = np.asarray(episode[4], dtype=np.float32).tostring()
     return req
     
 
@@ -56,7 +61,8 @@ def string_to_weights(weights):
 
 class RLClient:
 
-    def __init__(self, ip_address="127.0.0.1", port=8777, network_timeout=120):
+    def __init__(self, ip_address="127.0.0.1", port=8777, network_timeout=120,
+                 client_id=None):
         """ Class for RL Client which interacts with RL Server.
 
         Parameters
@@ -67,20 +73,45 @@ class RLClient:
             port number of the client
         network_timeout: int
             network timeout
+        client_id: int
+            if given, the client introduces itself to the single port
+            server (see AsyncRLServerAPI) with this id, again after
+            every reconnect
         """
         self._tcp_client = TCPClient(ip_address, port, network_timeout)
-        self._tcp_client.connect()
         self._tcp_lock = threading.Lock()
+        self._client_id = client_id
+        self._connect()
 
-    def store_episode(self, episode):
-        req = serialize(episode_to_req(episode, method="store_episode"))
-        with self._tcp_lock:
+    def _connect(self):
+        self._tcp_client.connect()
+        if self._client_id is not None:
+            req = serialize({"method": "hello", "client_id": self._client_id})
             self._tcp_client.write_and_read_with_retries(req)
 
+    def _write_and_read(self, req):
+        """ if the server closed the connection (e.g. the idle client
+            timed out), reconnect and repeat the request
+        """
+        try:
+            return self._tcp_client.write_and_read_with_retries(req)
+        except TCPConnectionClosedError as e:
+            print("--- rl client: {}, reconnecting".format(e))
+            self._tcp_client.disconnect()
+            self._connect()
+            return self._tcp_client.write_and_read_with_retries(req)
+
+    def store_episode(self, episode, algorithm_id=0):
+        req = episode_to_req(episode, method="store_episode")
+        req["algorithm_id"] = algorithm_id
+        req = serialize(req)
+        with self._tcp_lock:
+            self._write_and_read(req)
+
     def get_weights(self, index=0):
         req = serialize({"method": "get_weights", "index": index})
         with self._tcp_lock:
-            data = self._tcp_client.write_and_read_with_retries(req)
+            data = self._write_and_read(req)
             data = deserialize(data)
             string_to_weights(data)
             return data
@@ -1,10 +1,12 @@
+from functools import partial
+
 import numpy as np
 
 from .tcp_client_server import TCPServer
 from .serialization import serialize, deserialize
 
 
-def string_to_obs(strings, obs_shapes):
+def string_to_obs(strings, obs_shapes, obs_dtypes=None):
     """ Convert strings back to observations (or states).
 
     Parameters
@@ -13,6 +15,8 @@ def string_to_obs(strings, obs_shapes):
         which corresponds to the encoded observations (or states)
     obs_shapes: list of tuples [obs_shape_1, ..., obs_shape_n]
         shapes of corresponding observations (or states)
+    obs_dtypes: list of dtype strings [dtype_1, ..., dtype_n]
+        dtypes of corresponding observations, float32 if not given
 
     Returns
     -------
@@ -22,7 +26,8 @@ def string_to_obs(strings, obs_shapes):
     """
     obs_str = []
     for i, str_ in enumerate(strings):
-        obs = np.frombuffer(str_, dtype=np.float32)
+        dtype = np.float32 if obs_dtypes is None else np.dtype(obs_dtypes[i])
+        obs = np.frombuffer(str_, dtype=dtype)
         obs_str.append(obs.reshape((-1,)+obs_shapes[i]))
     return obs_str
 
@@ -30,10 +35,15 @@ def string_to_obs(strings, obs_shapes):
 def req_to_episode(req, obs_shapes):
     """ Preprocess deserealized request to obtain episode.
     """
-    observations = string_to_obs(req["observations"], obs_shapes)
+    observations = string_to_obs(
+        req["observations"], obs_shapes, req.get("observation_dtypes"))
     actions = np.array(req["actions"], dtype=np.float32)
     rewards = np.array(req["rewards"], dtype=np.float32)
     dones = np.array(req["dones"], dtype=np.bool)
+    if "recurrent_states" in req:
+        recurrent_states = np.frombuffer(
+            req["recurrent_states"], dtype=np.float32).reshape((len(dones), -1))
+        return [observations, actions, rewards, dones, recurrent_states]
     return [observations, actions, rewards, dones]
     
 
@@ -90,20 +100,27 @@ class RLServerAPI:
             server = TCPServer(self._ip_address,
                                self._init_port+i,
                                self._timeout)
-            server.listen(self.agent_listener)
+            server.listen(partial(self.agent_listener, client_id=i))
+
+    def agent_listener(self, request, client_id=0):
+        return serialize(self.process_request(deserialize(request), client_id))
 
-    def agent_listener(self, request):
+    def process_request(self, req, client_id=0):
 
-        req = deserialize(request)
         method = req["method"]
 
-        if method == "store_episode":
+        if method == "hello":
+            # optional handshake of the clients of the single port server
+            response = {"client_id": req["client_id"]}
+
+        elif method == "store_episode":
             episode = req_to_episode(req, self._observation_shapes)
-            self._store_episode_callback(episode)
+            self._store_episode_callback(
+                episode, req.get("algorithm_id", 0), client_id)
             response = ""
 
         elif method == "get_weights":
             response = self._get_weights_callback(req["index"])
             weights_to_string(response)
 
-        return serialize(response)
+        return response
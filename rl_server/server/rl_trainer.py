@@ -1,7 +1,13 @@
+import os
 import time
+import atexit
 from threading import Lock
 
-from rl_server.server.server_replay_buffer import ServerBuffer
+from rl_server.server.server_replay_buffer import (
+    ServerBuffer, get_available_memory, get_available_shared_memory)
+from rl_server.server.partitioned_replay_buffer import PartitionedServerBuffer
+from rl_server.server.cold_replay_storage import ColdStorage
+from rl_server.server.ingest_filters import create_ingest_filters
 from misc.rl_logger import RLServerLogger
 
 
@@ -11,7 +17,25 @@ class RLTrainer:
             observation_shapes,
             action_size,
             experience_replay_buffer_size=1000000,
+            experience_replay_buffer_path=None,
+            buffer_memory_gb=None,
+            prefault_buffer=False,
+            lock_free_buffer=False,
+            state_windows=False,
+            batches_per_sample=1,
+            observation_codecs=None,
+            action_codec=None,
             use_prioritized_buffer=False,
+            priority="proportional",
+            rank_sort_period=1000,
+            num_partitions=1,
+            recurrent_state_size=None,
+            cold_storage=None,
+            partition_mixing=None,
+            ingest_filters=None,
+            batch_prefetch_workers=0,
+            batch_prefetch_slots=None,
+            server_buffer=None,
             n_step=1,
             gamma=0.99,
             train_every_nth=4,
@@ -22,11 +46,14 @@ class RLTrainer:
             start_learning_after=5000,
             show_stats_period=2000,
             save_model_period=10000,
+            save_replay_buffer=False,
+            compress_replay_buffer=False,
             logdir="ckpt/"):
 
         self._observation_shapes = observation_shapes
         self._action_size = action_size
         self._buffer_size = experience_replay_buffer_size
+        self._buffer_path = experience_replay_buffer_path
         self._start_learning_after = start_learning_after
         self._n_step = n_step
         self._gamma = gamma
@@ -35,21 +62,145 @@ class RLTrainer:
         self._target_actor_update_period = target_actor_update_period
         self._show_stats_period = show_stats_period
         self._save_model_period = save_model_period
+        self._save_replay_buffer = save_replay_buffer
+        self._compress_replay_buffer = compress_replay_buffer
         self._hist_len = history_length
+        self._state_windows = state_windows
+        self._batches_per_sample = batches_per_sample
+        self._sampled_batches = []
         self._beta = initial_beta
         self._use_prioritized_buffer = use_prioritized_buffer
+        self._priority = priority
+        self._num_partitions = num_partitions
+        self._rank_sort_period = rank_sort_period
+        self._batch_prefetch_workers = batch_prefetch_workers
+        self._batch_prefetch_slots = batch_prefetch_slots
+        self._batch_fetcher = None
+        self._shared_buffer = None
         self._logdir = logdir
         self._logger = RLServerLogger(logdir)
+        self._ingest_filter = create_ingest_filters(ingest_filters)
+
+        if server_buffer is None and batch_prefetch_workers > 0:
+            # the shared buffer lives in /dev/shm and has none of these options
+            ignored = [name for name, value in (
+                ("experience_replay_buffer_path", experience_replay_buffer_path),
+                ("lock_free_buffer", lock_free_buffer),
+                ("prefault_buffer", prefault_buffer),
+                ("recurrent_state_size", recurrent_state_size)) if value]
+            if ignored:
+                raise ValueError(
+                    "{} cannot be used with batch_prefetch_workers > 0".format(", ".join(ignored)))
+
+        transition_nbytes = ServerBuffer.get_transition_nbytes(
+            observation_shapes, action_size, observation_codecs, action_codec,
+            prioritized=use_prioritized_buffer,
+            recurrent_state_size=recurrent_state_size)
+        if buffer_memory_gb is not None:
+            # capacity is derived from the memory budget
+            self._buffer_size = int(buffer_memory_gb * 2 ** 30) // transition_nbytes
+            print("--- replay buffer of {} GB holds {} transitions of {} bytes".format(
+                buffer_memory_gb, self._buffer_size, transition_nbytes))
+        required = self._buffer_size * transition_nbytes
+        if server_buffer is None and self._buffer_path is None:
+            available = get_available_memory()
+            if available is not None and required > available:
+                raise MemoryError(
+                    "replay buffer of {} transitions needs {:.2f} GB, "
+                    "only {:.2f} GB available".format(
+                        self._buffer_size, required / 2 ** 30, available / 2 ** 30))
+        if server_buffer is None and batch_prefetch_workers > 0:
+            # shared buffer is allocated in /dev/shm, which is usually
+            # limited to a part of the memory (and in docker to 64 MB)
+            available = get_available_shared_memory()
+            if available is not None and required > available:
+                raise MemoryError(
+                    "replay buffer of {} transitions needs {:.2f} GB of shared "
+                    "memory, only {:.2f} GB free in /dev/shm".format(
+                        self._buffer_size, required / 2 ** 30, available / 2 ** 30))
+
+        # snapshots are written and loaded only by the single ServerBuffer
+        self._buffer_snapshots_supported = server_buffer is None and num_partitions == 1
+        if save_replay_buffer and not self._buffer_snapshots_supported:
+            raise NotImplementedError(
+                "replay buffer snapshots are not supported by the partitioned "
+                "and graph replay buffers")
+        if cold_storage is not None and (
+                server_buffer is not None or num_partitions > 1 or batch_prefetch_workers > 0
+                or use_prioritized_buffer or batches_per_sample > 1):
+            raise ValueError(
+                "cold storage is sampled only by get_batch of the ServerBuffer, it is "
+                "not supported by the graph, partitioned and shared buffers, "
+                "prioritized replay and batches_per_sample > 1")
+        if use_prioritized_buffer and num_partitions > 1:
+            raise NotImplementedError(
+                "prioritized replay is not supported by the partitioned buffer")
 
         # sync buffer
-        self.server_buffer = ServerBuffer(
-            self._buffer_size, observation_shapes, action_size)
+        if server_buffer is not None:
+            # created with the algorithm, e.g. GraphReplayBuffer
+            self.server_buffer = server_buffer
+        elif batch_prefetch_workers > 0:
+            # batches are prepared by sampler processes attached to the
+            # buffer in shared memory, see _get_batch_fetcher
+            if num_partitions > 1:
+                raise NotImplementedError(
+                    "batch prefetching is not supported by the partitioned buffer")
+            # multiprocessing.shared_memory needs python 3.8
+            from rl_server.server.shared_replay_buffer import SharedServerBuffer
+            self.server_buffer = SharedServerBuffer(
+                "tars_replay_{}".format(os.getpid()),
+                self._buffer_size, observation_shapes, action_size,
+                observation_codecs=observation_codecs,
+                action_codec=action_codec)
+            self._shared_buffer = self.server_buffer
+            # shared memory outlives the process unless it is unlinked
+            atexit.register(self.close)
+        elif num_partitions > 1:
+            # one partition per algorithm of the ensemble
+            self.server_buffer = PartitionedServerBuffer(
+                self._buffer_size, observation_shapes, action_size,
+                num_partitions,
+                mixing=partition_mixing,
+                storage_path=self._buffer_path,
+                observation_codecs=observation_codecs,
+                action_codec=action_codec,
+                lock_free=lock_free_buffer,
+                recurrent_state_size=recurrent_state_size,
+                prefault=prefault_buffer)
+        else:
+            self.server_buffer = ServerBuffer(
+                self._buffer_size, observation_shapes, action_size,
+                prioritized=use_prioritized_buffer,
+                storage_path=self._buffer_path,
+                observation_codecs=observation_codecs,
+                action_codec=action_codec,
+                lock_free=lock_free_buffer,
+                rank_sort_period=rank_sort_period,
+                recurrent_state_size=recurrent_state_size,
+                cold_storage=None if cold_storage is None else ColdStorage(**cold_storage),
+                prefault=prefault_buffer)
+        # memory-mapped buffer writes its header every few pushes,
+        # the last ones are written by flush on exit
+        self._buffer_mapped = server_buffer is None and batch_prefetch_workers == 0 \
+            and self._buffer_path is not None
+        if self._buffer_mapped:
+            atexit.register(self.close)
+        self.server_buffer.register_n_step(n_step, gamma)
+
+        memory_usage = self.server_buffer.get_memory_usage()
+        self._logger.log_memory(memory_usage)
+        for name, nbytes in sorted(memory_usage.items()):
+            print("--- replay buffer {}: {:.1f} MB".format(name, nbytes / 2 ** 20))
+        print("--- replay buffer total: {:.2f} GB".format(
+            sum(memory_usage.values()) / 2 ** 30))
         self._train_loop_step_lock = Lock()
 
         self._step_index = 0
         self._target_actor_update_num = 0
         self._target_critic_update_num = 0
         self._n_saved = 0
+        self._buffer_snapshots = []
 
     def set_algorithm(self, algo):
         self._algo = algo
@@ -57,8 +208,55 @@ class RLTrainer:
     def init(self):
         pass
 
-    def store_episode(self, episode):
-        self.server_buffer.push_episode(episode)
+    def store_episode(self, episode, algorithm_id=0, agent_id=0):
+        if self._ingest_filter is not None:
+            episode = self._ingest_filter(episode, agent_id)
+            if episode is None:
+                return
+        if self._num_partitions > 1:
+            self.server_buffer.push_episode(episode, algorithm_id)
+        else:
+            self.server_buffer.push_episode(episode)
+
+    def close(self):
+        """ stop sampler processes, free the shared memory and write
+            the header of the memory-mapped buffer
+        """
+        if self._buffer_mapped:
+            self.server_buffer.flush()
+        if self._batch_fetcher is not None:
+            self._batch_fetcher.stop()
+            self._batch_fetcher = None
+        if self._shared_buffer is not None:
+            self._shared_buffer.close()
+            self._shared_buffer = None
+
+    def _get_batch_fetcher(self, batch_size):
+        """ sampler processes for the current batch size,
+            they are restarted when the schedule changes it
+        """
+        if self._batch_fetcher is not None and self._batch_fetcher.batch_size != batch_size:
+            self._batch_fetcher.stop()
+            self._batch_fetcher = None
+        if self._batch_fetcher is None:
+            from rl_server.server.parallel_batch_fetcher import ParallelBatchFetcher
+            self._batch_fetcher = ParallelBatchFetcher(
+                self.server_buffer,
+                dict(
+                    batch_size=batch_size,
+                    history_len=self._hist_len,
+                    n_step=self._n_step,
+                    gamma=self._gamma,
+                    window=self._state_windows,
+                    start_after=self._start_learning_after,
+                    priority=self._priority,
+                    beta=self._beta),
+                num_workers=self._batch_prefetch_workers,
+                num_slots=self._batch_prefetch_slots,
+                prioritized=self._use_prioritized_buffer,
+                rank_sort_period=self._rank_sort_period)
+            self._batch_fetcher.start()
+        return self._batch_fetcher
 
     # for asynchronous acts and trains
     def start_training(self):
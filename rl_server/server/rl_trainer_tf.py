@@ -1,9 +1,12 @@
 import os
+import atexit
 import multiprocessing
+from threading import Thread
 
 import tensorflow as tf
 
 from rl_server.server.rl_trainer import RLTrainer
+from rl_server.tensorflow.algo.base_algo import BatchStagingQueue
 
 
 def make_session(num_cpu=None, make_default=False, graph=None):
@@ -26,37 +29,40 @@ class TFRLTrainer(RLTrainer):
         self._saver = tf.train.Saver(max_to_keep=None)
         self._algo.init(self._sess)
         self._algo.target_network_init(self._sess)
+        # batches are taken in graph from the staging queue
+        # (server.batch_staging_capacity) or the graph replay buffer
+        self._batch_source = getattr(self._algo, 'batch_source', None)
+        self._staging_thread = None
+        self._staging_error = None
+        self._staging_stopped = False
+        if isinstance(self._batch_source, BatchStagingQueue):
+            atexit.register(self.close)
+        if self._batch_source is not None and self._use_prioritized_buffer:
+            raise NotImplementedError(
+                "prioritized batches are fed with their importance "
+                "weights, in-graph batches do not support them")
+        if self._batch_source is self.server_buffer:
+            self.server_buffer.set_session(self._sess)
 
     def load_checkpoint(self, path):
         self._saver.restore(self._sess, path)
+        buffer_path = path + ".buffer"
+        if self._buffer_snapshots_supported and os.path.isfile(buffer_path):
+            self.server_buffer.load(buffer_path)
 
     def train_step(self):
 
         queue_size = self.server_buffer.get_stored_in_buffer()
         self._logger.log_buffer_size(queue_size, self._step_index)
 
-        if self._use_prioritized_buffer:
+        batch_size = self._algo.get_batch_size(self._step_index)
 
-            batch_size = self._algo.get_batch_size(self._step_index)
-            prio_batch = self.server_buffer.get_prioritized_batch(
-                batch_size,
-                history_len=self._hist_len,
-                n_step=self._n_step,
-                beta=self._beta,
-                gamma=self._gamma)
-            batch, indices, is_weights = prio_batch
-            train_info = self._algo.train(self._sess, self._step_index, batch, is_weights)
-            td_errors = self._algo.get_td_errors(self._sess, batch).ravel()
-            self.server_buffer.update_td_errors(indices, td_errors)
-            self._beta = min(1.0, self._beta + 1e-6)
+        if self._batch_source is not None:
+            train_info = self._train_in_graph(batch_size)
+        elif self._batch_prefetch_workers > 0:
+            train_info = self._train_prefetched(batch_size)
         else:
-            batch_size = self._algo.get_batch_size(self._step_index)
-            batch = self.server_buffer.get_batch(
-                batch_size,
-                history_len=self._hist_len,
-                n_step=self._n_step,
-                gamma=self._gamma)
-            train_info = self._algo.train(self._sess, self._step_index, batch)
+            train_info = self._train_sampled(batch_size)
 
         self._logger.log_train(train_info, self._step_index)
 
@@ -75,9 +81,142 @@ class TFRLTrainer(RLTrainer):
                     queue_size
                 )
             )
+            if self._ingest_filter is not None:
+                ingest_stats = self._ingest_filter.get_stats()
+                self._logger.log_ingest(ingest_stats, self._step_index)
+                print("--- ingest: {}".format(ingest_stats))
 
         self.save()
 
+    def _train_sampled(self, batch_size):
+        """ train on the batch sampled from the buffer in this process
+        """
+        # batch is consumed within the step, so two reused buffers are enough,
+        # batches sampled ahead stay alive until they are consumed
+        self.server_buffer.register_batch_buffers(
+            batch_size, self._hist_len, self._n_step, self._state_windows,
+            num_buffers=max(2, self._batches_per_sample))
+        if self._use_prioritized_buffer:
+
+            prio_batch = self.server_buffer.get_prioritized_batch(
+                batch_size,
+                history_len=self._hist_len,
+                n_step=self._n_step,
+                priority=self._priority,
+                beta=self._beta,
+                gamma=self._gamma,
+                window=self._state_windows)
+            batch, indices, is_weights, generations = prio_batch
+            train_info = self._algo.train(self._sess, self._step_index, batch, is_weights)
+            td_errors = self._algo.get_td_errors(self._sess, batch).ravel()
+            self.server_buffer.update_td_errors(indices, td_errors, generations)
+            self._beta = min(1.0, self._beta + 1e-6)
+        elif self._batches_per_sample > 1:
+            if not self._sampled_batches or len(self._sampled_batches[-1].r) != batch_size:
+                self._sampled_batches = self.server_buffer.get_batches(
+                    self._batches_per_sample,
+                    batch_size,
+                    history_len=self._hist_len,
+                    n_step=self._n_step,
+                    gamma=self._gamma,
+                    window=self._state_windows)
+            batch = self._sampled_batches.pop()
+            train_info = self._algo.train(self._sess, self._step_index, batch)
+        else:
+            batch = self.server_buffer.get_batch(
+                batch_size,
+                history_len=self._hist_len,
+                n_step=self._n_step,
+                gamma=self._gamma,
+                window=self._state_windows)
+            train_info = self._algo.train(self._sess, self._step_index, batch)
+        return train_info
+
+    def _train_in_graph(self, batch_size):
+        """ train on the batch taken in graph, it is either sampled by
+            the graph replay buffer or dequeued from the staging queue
+            which is filled by the staging thread
+        """
+        if isinstance(self._batch_source, BatchStagingQueue):
+            if self._staging_thread is None:
+                self._staging_thread = Thread(target=self._stage_batches, daemon=True)
+                self._staging_thread.start()
+        else:
+            self._batch_source.set_batch_size(batch_size)
+        try:
+            return self._algo.train(self._sess, self._step_index, None)
+        except tf.errors.OutOfRangeError:
+            # the staging thread closes the queue when it fails
+            if self._staging_error is not None:
+                raise RuntimeError("batch staging failed") from self._staging_error
+            raise
+
+    def _stage_batches(self):
+        """ staging thread: sample batches and enqueue them until the queue
+            is closed, on failure the queue is closed as well, so the train
+            step waiting for the next batch raises instead of blocking
+        """
+        try:
+            while not self._staging_stopped:
+                batch_size = self._algo.get_batch_size(self._step_index)
+                if self._batch_prefetch_workers > 0:
+                    batch = None
+                    while batch is None and not self._staging_stopped:
+                        batch = self._get_batch_fetcher(batch_size).get_batch()
+                    if batch is None:
+                        break
+                else:
+                    # enqueue copies the batch, so one reused buffer is enough
+                    self.server_buffer.register_batch_buffers(
+                        batch_size, self._hist_len, self._n_step, self._state_windows,
+                        num_buffers=1)
+                    batch = self.server_buffer.get_batch(
+                        batch_size,
+                        history_len=self._hist_len,
+                        n_step=self._n_step,
+                        gamma=self._gamma,
+                        window=self._state_windows)
+                self._batch_source.enqueue(self._sess, batch)
+        except tf.errors.CancelledError:
+            # queue is closed by close()
+            pass
+        except Exception as e:
+            print("--- batch staging failed: {}".format(repr(e)))
+            self._staging_error = e
+            self._batch_source.close(self._sess)
+            raise
+
+    def close(self):
+        """ close the staging queue, which cancels the pending enqueue
+            of the staging thread, then stop sampler processes
+        """
+        if getattr(self, "_staging_thread", None) is not None and not self._staging_stopped:
+            self._staging_stopped = True
+            self._batch_source.close(self._sess)
+            self._staging_thread.join(timeout=10)
+        super().close()
+
+    def _train_prefetched(self, batch_size):
+        """ train on the batch prepared by the sampler processes,
+            td errors of prioritized batches are sent back to them
+        """
+        batch_fetcher = self._get_batch_fetcher(batch_size)
+        if self._use_prioritized_buffer:
+            prio_batch = None
+            while prio_batch is None:
+                prio_batch = batch_fetcher.get_prioritized_batch(self._beta)
+            batch, indices, is_weights, generations = prio_batch
+            train_info = self._algo.train(self._sess, self._step_index, batch, is_weights)
+            td_errors = self._algo.get_td_errors(self._sess, batch).ravel()
+            batch_fetcher.update_td_errors(indices, td_errors, generations)
+            self._beta = min(1.0, self._beta + 1e-6)
+        else:
+            batch = None
+            while batch is None:
+                batch = batch_fetcher.get_batch()
+            train_info = self._algo.train(self._sess, self._step_index, batch)
+        return train_info
+
     def save(self):
         if self._step_index % self._save_model_period == 0:
             save_path = self._saver.save(
@@ -85,6 +224,20 @@ class TFRLTrainer(RLTrainer):
                     self._step_index)))
             print("Model saved in file: %s" % save_path)
             self._n_saved += 1
+            if self._buffer_mapped:
+                self.server_buffer.flush()
+            if self._save_replay_buffer:
+                self.save_buffer(save_path + ".buffer")
+
+    def save_buffer(self, path):
+        # keep only the last complete snapshot and the one being written
+        self.server_buffer.wait_save()
+        for old_path in self._buffer_snapshots[:-1]:
+            if os.path.isfile(old_path):
+                os.remove(old_path)
+        self._buffer_snapshots = self._buffer_snapshots[-1:] + [path]
+        self.server_buffer.save(
+            path, compress=self._compress_replay_buffer, background=True)
 
     def get_weights(self, index=0):
         return self._algo.get_weights(self._sess, index)
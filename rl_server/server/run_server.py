@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
+import sys
+import signal
+
 from rl_server.tensorflow.rl_server import RLServer
 from rl_server.tensorflow.algo.algo_fabric import create_algorithm
-from rl_server.tensorflow.algo.base_algo import create_placeholders
+from rl_server.tensorflow.algo.base_algo import (
+    create_placeholders,
+    create_placeholders_n_algos_with_split
+)
 from rl_server.tensorflow.algo.algo_ensemble import AlgoEnsemble
+from rl_server.tensorflow.graph_replay_buffer import create_graph_replay_buffer
 from misc.common import create_if_need, set_global_seeds, parse_server_args
 from misc.config import load_config
 
@@ -13,25 +20,58 @@ exp_config = load_config(args.config)
 set_global_seeds(exp_config.server.seed)
 create_if_need(exp_config.server.logdir)
 
-if exp_config.is_ensemble():
+_, state_shapes, action_size = exp_config.get_env_shapes()
 
-    _, state_shapes, action_size = exp_config.get_env_shapes()
+# batch sources are built only in the server graph, agents feed states
+window_n_step = None
+if getattr(exp_config.server, 'overlapping_state_windows', False):
+    window_n_step = exp_config.algorithm.n_step
+staging_capacity = getattr(exp_config.server, 'batch_staging_capacity', None)
+graph_replay_buffer = create_graph_replay_buffer(exp_config)
 
-    big_batch_ph = create_placeholders(
-        state_shapes,
-        action_size
-    )
+if exp_config.is_ensemble():
+
+    num_algos = len(exp_config.ensemble.algorithms)
+    if getattr(exp_config.server, 'partitioned_buffer', False):
+        # every algorithm is trained on its own slice of the big batch
+        big_batch_ph, algo_batches_ph = create_placeholders_n_algos_with_split(
+            state_shapes,
+            action_size,
+            num_algos,
+            window_n_step,
+            staging_capacity,
+            graph_replay_buffer
+        )
+    else:
+        big_batch_ph = create_placeholders(
+            state_shapes,
+            action_size,
+            window_n_step,
+            staging_capacity,
+            graph_replay_buffer
+        )
+        algo_batches_ph = [big_batch_ph] * num_algos
 
     ensemble_algorithms = [
         create_algorithm(
             exp_config.get_algo_config(i),
-            big_batch_ph,
+            algo_batches_ph[i],
             i
-        ) for i in range(len(exp_config.ensemble.algorithms))
+        ) for i in range(num_algos)
     ]
     agent_algorithm = AlgoEnsemble(ensemble_algorithms, big_batch_ph)
 else:
-    agent_algorithm = create_algorithm(exp_config)
+    placeholders = create_placeholders(
+        state_shapes,
+        action_size,
+        window_n_step,
+        staging_capacity,
+        graph_replay_buffer
+    )
+    agent_algorithm = create_algorithm(exp_config, placeholders)
+
+# exit through atexit handlers on SIGTERM as well, they free shared memory
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
 rl_server = RLServer(exp_config, agent_algorithm)
 if hasattr(exp_config.server, 'load_checkpoint'):
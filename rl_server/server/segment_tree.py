@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class SegmentTree:
+
+    def __init__(self, capacity, operation, neutral_element):
+        """ Array-backed binary segment tree, all operations are
+            vectorized over a batch of indices and done level by level.
+
+        Parameters
+        ----------
+        capacity: int
+            number of leaves, rounded up to the power of two
+        operation: np.ufunc
+            associative operation which combines two children (np.add, np.minimum)
+        neutral_element: float
+            value of the empty leaves (0 for sum, inf for min)
+        """
+        self._capacity = 1
+        while self._capacity < capacity:
+            self._capacity *= 2
+        self._operation = operation
+        self._neutral_element = neutral_element
+        # node i has children 2i and 2i+1, root is at 1, leaves start at capacity
+        self._tree = np.full(2 * self._capacity, neutral_element, dtype=np.float64)
+
+    def reduce(self):
+        return self._tree[1]
+
+    def __getitem__(self, indices):
+        return self._tree[self._capacity + np.asarray(indices)]
+
+    def __setitem__(self, indices, values):
+        nodes = self._capacity + np.asarray(indices).reshape(-1)
+        if len(nodes) == 0:
+            return
+        self._tree[nodes] = values
+        # all leaves are on the same level, so parents are updated level by level
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._operation(
+                self._tree[2 * nodes], self._tree[2 * nodes + 1])
+
+
+class SumTree(SegmentTree):
+
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, 0.0)
+
+    def sum(self):
+        return self.reduce()
+
+    def find_prefixsum_idx(self, prefixsums):
+        """ for every prefixsum find the highest index i such that
+            sum(tree[:i]) <= prefixsum, descending all the batch at once
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(len(prefixsums), dtype=np.int64)
+        while nodes[0] < self._capacity:
+            left = self._tree[2 * nodes]
+            go_right = prefixsums > left
+            prefixsums -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self._capacity
+
+
+class MinTree(SegmentTree):
+
+    def __init__(self, capacity):
+        super().__init__(capacity, np.minimum, np.inf)
+
+    def min(self):
+        return self.reduce()
@@ -1,57 +1,628 @@
+import os
+import json
+import zlib
 import random
+import struct
+import itertools
 from collections import namedtuple
-from threading import RLock
+from threading import RLock, Thread
 
 import numpy as np
 
+from rl_server.server.segment_tree import SumTree, MinTree
+from rl_server.server.storage_codecs import Float32Codec
 
 Transition = namedtuple("Transition", ("s", "a", "r", "s_", "done"))
+# states and next states share one window of history_len + n_step observations,
+# for every observation part s = window[:, :history_len], s_ = window[:, n_step:]
+WindowTransition = namedtuple("WindowTransition", ("s_window", "a", "r", "done"))
+# contiguous sequences for recurrent networks, observations are given per part,
+# see ServerBuffer.get_sequence_batch
+SequenceTransition = namedtuple(
+    "SequenceTransition", ("s", "a", "r", "done", "offsets", "mask", "initial_state"))
+NStepReturns = namedtuple("NStepReturns", ("returns", "offsets", "dones"))
+
+
+def discounted_n_step_returns(rewards, dones, valid, gamma=0.99):
+    """ Compute n-step returns for a batch of transitions.
+
+    Parameters
+    ----------
+    rewards, dones: np.arrays of shape (batch_size, n_step)
+        next n_step rewards and dones of every transition
+    valid: np.array of shape (batch_size, n_step)
+        whether the step belongs to the same episode
+    gamma: float
+        discount factor
+
+    Returns
+    -------
+    returns: discounted sum of rewards truncated after the first done
+    offsets: number of steps to the bootstrap (next) state
+    dones: whether the episode ended within these steps
+    """
+    # reward at step k is used only if there were no dones before it
+    used = valid.copy()
+    used[:, 1:] &= np.cumsum(dones[:, :-1], axis=1) == 0
+    discounts = np.power(gamma, np.arange(rewards.shape[1]), dtype=np.float32)
+    returns = np.sum(rewards * discounts * used, axis=1)
+    return returns, used.sum(axis=1), np.any(dones & used, axis=1)
+
+
+def get_available_memory():
+    """ memory available for new allocations in bytes,
+        None if it is unknown (/proc/meminfo is linux only)
+    """
+    try:
+        with open("/proc/meminfo", "rt") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_available_shared_memory(path="/dev/shm"):
+    """ free space of the shared memory file system in bytes,
+        None if there is no such file system
+    """
+    if not os.path.isdir(path):
+        return None
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def batch_rows(batch, start, end):
+    """ view of the rows start:end of the batch
+    """
+    return type(batch)(*[
+        # states are given per observation part
+        [part[start:end] for part in field]
+        if name in ("s", "s_", "s_window") else field[start:end]
+        for name, field in zip(batch._fields, batch)])
+
+
+class BatchPool:
+
+    def __init__(self, allocate):
+        """ preallocated batches returned round-robin per batch parameters,
+            allocate(batch_size, history_len, n_step, window) makes a new one
+        """
+        self._allocate = allocate
+        self._buffers = {}
+
+    def register(self, key, num_buffers):
+        if key not in self._buffers:
+            self._buffers[key] = (
+                [self._allocate(*key) for _ in range(num_buffers)], itertools.count())
+
+    def next(self, key, pooled=True):
+        """ next pooled batch, or a new one if not pooled or not registered
+        """
+        if not pooled or key not in self._buffers:
+            return self._allocate(*key)
+        buffers, counter = self._buffers[key]
+        return buffers[next(counter) % len(buffers)]
+
+    def can_pool(self, key, num_batches):
+        """ whether num_batches returned together can be pooled,
+            they must not share arrays
+        """
+        buffers, _ = self._buffers.get(key, ([], None))
+        return num_batches <= len(buffers)
 
 
 class ServerBuffer:
 
-    def __init__(self, capacity, observation_shapes, action_size):
+    def __init__(self, capacity, observation_shapes, action_size,
+                 prioritized=False, alpha=0.6, storage_path=None,
+                 observation_codecs=None, action_codec=None,
+                 lock_free=False, segment_size=1024, rank_sort_period=1000,
+                 recurrent_state_size=None, cold_storage=None, prefault=False,
+                 header_period=100):
+        """ Replay buffer of the server.
+
+        Parameters
+        ----------
+        capacity: int
+            maximal number of stored transitions
+        observation_shapes: list of tuples [obs_shape_1, ..., obs_shape_n]
+            which corresponds to observations" shapes
+        action_size: int
+            size of the action vector
+        prioritized: bool
+            whether to maintain priorities for get_prioritized_batch
+        alpha: float
+            priority exponent of the prioritized replay
+        rank_sort_period: int
+            number of priority updates after which the rank order of the
+            rank-based prioritized replay is recomputed
+        recurrent_state_size: int
+            if given, recurrent (LSTM) states which agents attach to the
+            episodes are stored for get_sequence_batch
+        cold_storage: ColdStorage
+            if given, transitions evicted from the ring are kept on disk
+            and get_batch takes a fraction of the batch from there
+        storage_path: str
+            if given, arrays are np.memmap files in this folder, existing
+            buffer in the folder is reattached instead of being recreated
+        header_period: int
+            number of pushed episodes after which the header (pointer and
+            counters) of the storage_path buffer is rewritten, flush writes
+            it as well, episodes pushed after the last header are lost when
+            the buffer is reattached
+        observation_codecs: list of codecs [codec_1, ..., codec_n]
+            compact storage of observation parts, values are decoded
+            to float32 only in sampled batches (float32 by default)
+        action_codec: codec
+            compact storage of actions
+        lock_free: bool
+            single writer ring mode, samplers never take the lock of the
+            writer: they read only committed slots and resample transitions
+            whose ring segments were written while the batch was gathered
+        segment_size: int
+            number of slots guarded by one sequence number in lock-free mode,
+            must be greater than history_len + n_step
+        prefault: bool
+            touch every page of the in-memory arrays at startup, so the
+            buffer fails to allocate right away instead of when it fills up
+        """
         self.size = capacity
         self.num_in_buffer = 0
         self.stored_in_buffer = 0
         self.num_parts = len(observation_shapes)
-        self.obs_shapes = observation_shapes
+        self.obs_shapes = [tuple(shape) for shape in observation_shapes]
         self.act_shape = (action_size,)
+        self.pointer = 0
+        self.obs_codecs = observation_codecs or [Float32Codec() for _ in range(self.num_parts)]
+        self.act_codec = action_codec or Float32Codec()
+
+        self.storage_path = storage_path
+        self.header_period = header_period
+        self._pushes_since_header = 0
+        header = None
+        if self.storage_path is not None:
+            header = self._read_header()
 
         # initialize all np.arrays which store necessary data
         self.observations = []
         for part_id in range(self.num_parts):
-            obs = np.empty((self.size, ) + self.obs_shapes[part_id], dtype=np.float32)
+            obs = self._allocate(
+                "observations" + str(part_id), self.obs_shapes[part_id], self.obs_codecs[part_id].dtype)
             self.observations.append(obs)
-        self.actions = np.empty((self.size, ) + self.act_shape, dtype=np.float32)
-        self.rewards = np.empty((self.size, ), dtype=np.float32)
-        self.dones = np.empty((self.size, ), dtype=np.bool)
-        self.td_errors = np.empty((self.size, ), dtype=np.float32)
+        self.actions = self._allocate("actions", self.act_shape, self.act_codec.dtype)
+        self.rewards = self._allocate("rewards", (), np.float32)
+        self.dones = self._allocate("dones", (), np.bool)
+        self.td_errors = self._allocate("td_errors", (), np.float32)
+        # position of the transition within its episode (0 for the first one)
+        self.episode_offsets = self._allocate("episode_offsets", (), np.int32)
+        self.recurrent_state_size = recurrent_state_size
+        self.recurrent_states = None
+        if self.recurrent_state_size is not None:
+            # state of the agent before it processed the observation of the slot
+            self.recurrent_states = self._allocate(
+                "recurrent_states", (self.recurrent_state_size, ), np.float32)
 
-        self.pointer = 0
+        if header is not None:
+            self.pointer = header["pointer"]
+            self.num_in_buffer = header["num_in_buffer"]
+            self.stored_in_buffer = header["stored_in_buffer"]
+            print("--- reattached replay buffer {} with {} transitions".format(
+                self.storage_path, self.num_in_buffer))
+
+        # priorities p_i^alpha are kept in the sum and min trees,
+        # new transitions get the max priority seen so far
+        self.prioritized = prioritized
+        self.alpha = alpha
+        if self.prioritized:
+            self._sum_tree = SumTree(self.size)
+            self._min_tree = MinTree(self.size)
+            self._max_priority = 1.0
+            # number of times every slot was written, td errors computed
+            # for the previous transitions of the slot are dropped on update
+            self.generations = np.zeros((self.size, ), dtype=np.int64)
+            self.stale_td_updates = 0
+            # rank-based priorities: slots ordered by priority, sorted lazily
+            self.rank_sort_period = rank_sort_period
+            self._rank_buckets = None
+            self._restore_priorities()
+
+        # n-step returns are precomputed at insert time for every (n_step, gamma)
+        self._n_step_returns = {}
+
+        # store lock guards priorities (and everything in the default mode),
+        # write lock serializes writers, in the default mode it is the same lock
         self._store_lock = RLock()
+        self.lock_free = lock_free
+        self._write_lock = RLock() if self.lock_free else self._store_lock
+        if self.lock_free:
+            # segment is being written while its sequence number is odd
+            self.segment_size = segment_size
+            num_segments = (self.size + segment_size - 1) // segment_size
+            self._segment_seqs = self._allocate_segment_seqs(num_segments)
+        self._save_thread = None
+        self.cold_storage = cold_storage
+        if self.cold_storage is not None:
+            self.cold_storage.attach(self)
+        # pools of preallocated batches filled in place by get_batch
+        self._batch_buffers = BatchPool(self._allocate_batch)
+        self._rng = np.random.default_rng()
+        self._prefault = prefault
+        if self._prefault:
+            for _, array in self._stored_arrays():
+                self._prefault_array(array)
+
+    @staticmethod
+    def get_transition_nbytes(observation_shapes, action_size,
+                              observation_codecs=None, action_codec=None,
+                              prioritized=False, recurrent_state_size=None,
+                              num_n_steps=1):
+        """ memory taken by one slot of the buffer in bytes: stored arrays,
+            precomputed returns of num_n_steps (n_step, gamma) pairs and,
+            if prioritized, generations and two priority trees (a tree has
+            at most 4 float64 nodes per slot, the upper bound is taken)
+        """
+        observation_codecs = observation_codecs or [Float32Codec() for _ in observation_shapes]
+        action_codec = action_codec or Float32Codec()
+        nbytes = sum(
+            int(np.prod(shape)) * np.dtype(codec.dtype).itemsize
+            for shape, codec in zip(observation_shapes, observation_codecs))
+        nbytes += action_size * np.dtype(action_codec.dtype).itemsize
+        # rewards, dones, td_errors, episode_offsets
+        nbytes += 4 + 1 + 4 + 4
+        if recurrent_state_size is not None:
+            nbytes += 4 * recurrent_state_size
+        # returns, offsets, dones
+        nbytes += num_n_steps * (4 + 4 + 1)
+        if prioritized:
+            nbytes += 8 + 2 * 4 * 8
+        return nbytes
+
+    def get_memory_usage(self):
+        """ bytes taken by every array of the buffer
+        """
+        usage = {name: array.nbytes for name, array in self._stored_arrays()}
+        for (n_step, gamma), n_step_returns in self._n_step_returns.items():
+            usage["n_step_returns_{}_{}".format(n_step, gamma)] = sum(
+                array.nbytes for array in n_step_returns)
+        if self.prioritized:
+            usage["generations"] = self.generations.nbytes
+            usage["priority_trees"] = self._sum_tree._tree.nbytes + self._min_tree._tree.nbytes
+        return usage
+
+    @staticmethod
+    def _prefault_array(array, page_size=4096):
+        """ write one byte per page, memory-mapped files are not touched
+        """
+        if isinstance(array, np.memmap) or array.size == 0:
+            return
+        array.reshape(-1).view(np.uint8)[::page_size] = 0
+
+    def _allocate_segment_seqs(self, num_segments):
+        return np.zeros((num_segments, ), dtype=np.int64)
+
+    def _stored_arrays(self):
+        """ arrays which hold the state of the buffer
+        """
+        arrays = [("observations" + str(part_id), obs) for part_id, obs in enumerate(self.observations)]
+        arrays += [
+            ("actions", self.actions),
+            ("rewards", self.rewards),
+            ("dones", self.dones),
+            ("td_errors", self.td_errors),
+            ("episode_offsets", self.episode_offsets)
+        ]
+        if self.recurrent_states is not None:
+            arrays.append(("recurrent_states", self.recurrent_states))
+        return arrays
+
+    def _header_path(self):
+        return os.path.join(self.storage_path, "header.json")
+
+    def _read_header(self):
+        """ read the header of the buffer stored in storage_path,
+            returns None if there is no buffer yet
+        """
+        if not os.path.isfile(self._header_path()):
+            return None
+        with open(self._header_path(), "rt") as f:
+            header = json.load(f)
+        stored_shapes = [tuple(shape) for shape in header["observation_shapes"]]
+        if (header["capacity"] != self.size or stored_shapes != self.obs_shapes
+                or tuple(header["action_shape"]) != self.act_shape):
+            raise ValueError(
+                "replay buffer in {} has capacity {} and shapes {}, {}".format(
+                    self.storage_path, header["capacity"],
+                    stored_shapes, header["action_shape"]))
+        return header
+
+    def _write_header(self):
+        self._pushes_since_header = 0
+        header = {
+            "capacity": self.size,
+            "observation_shapes": self.obs_shapes,
+            "action_shape": self.act_shape,
+            "pointer": self.pointer,
+            "num_in_buffer": self.num_in_buffer,
+            "stored_in_buffer": self.stored_in_buffer
+        }
+        tmp_path = self._header_path() + ".tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump(header, f)
+        os.replace(tmp_path, self._header_path())
+
+    def _allocate(self, name, shape, dtype):
+        """ allocate an array of shape (capacity, ) + shape, either in memory
+            or as a memory-mapped file which is reused if it already exists
+        """
+        shape = (self.size, ) + tuple(shape)
+        if self.storage_path is None:
+            # zeroed pages are allocated lazily as well
+            return np.zeros(shape, dtype=dtype)
+
+        os.makedirs(self.storage_path, exist_ok=True)
+        path = os.path.join(self.storage_path, name + ".npy")
+        if os.path.isfile(self._header_path()) and os.path.isfile(path):
+            array = np.lib.format.open_memmap(path, mode="r+")
+            if array.shape != shape or array.dtype != dtype:
+                raise ValueError(
+                    "stored array {} has shape {} and dtype {}, expected {} and {}".format(
+                        path, array.shape, array.dtype, shape, np.dtype(dtype)))
+            return array
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def _restore_priorities(self):
+        """ rebuild priority trees from the stored td errors
+        """
+        self._ranked = None
+        self._rank_updates = 0
+        # slots written since the last sort of the rank order
+        self._rank_fresh = []
+        if self.num_in_buffer > 0:
+            indices = np.arange(self.num_in_buffer)
+            priorities = np.abs(self.td_errors[indices]) + 1e-6
+            self._max_priority = max(self._max_priority, priorities.max())
+            self._sum_tree[indices] = priorities ** self.alpha
+            self._min_tree[indices] = priorities ** self.alpha
+
+    def _prioritize_new(self, indices):
+        """ slots of new transitions get the max priority and,
+            until the next sort, the top ranks of the rank order
+        """
+        self.generations[indices] += 1
+        priorities = self._max_priority ** self.alpha
+        self._sum_tree[indices] = priorities
+        self._min_tree[indices] = priorities
+        if self._ranked is not None:
+            self._rank_fresh.append(indices)
+
+    def flush(self):
+        """ flush memory-mapped arrays and the header to disk
+        """
+        if self.storage_path is not None:
+            with self._write_lock:
+                for _, array in self._stored_arrays():
+                    array.flush()
+                self._write_header()
+
+    def save(self, path, compress=False, background=False, chunk_size=65536):
+        """ Write a snapshot of the buffer to a single file.
+
+        Parameters
+        ----------
+        path: str
+            snapshot file, it is written to path.tmp and renamed when complete
+        compress: bool
+            compress chunks with zlib
+        background: bool
+            write in a separate thread, the write lock is taken only
+            to copy every chunk and, at the end, the slots written
+            since the start, so training and ingest continue
+        chunk_size: int
+            number of transitions per chunk
+
+        Returns
+        -------
+        thread which writes the snapshot if background is True
+        """
+        self.wait_save()
+        if background:
+            self._save_thread = Thread(
+                target=self._save, args=(path, compress, chunk_size))
+            self._save_thread.start()
+            return self._save_thread
+        self._save(path, compress, chunk_size)
+
+    def wait_save(self):
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+
+    def _save(self, path, compress, chunk_size):
+        with self._write_lock:
+            header = {
+                "capacity": self.size,
+                "observation_shapes": self.obs_shapes,
+                "action_shape": self.act_shape,
+                "pointer": self.pointer,
+                "num_in_buffer": self.num_in_buffer,
+                "stored_in_buffer": self.stored_in_buffer,
+                "max_priority": float(getattr(self, "_max_priority", 1.0)),
+                "compress": compress,
+                "chunk_size": chunk_size,
+                "arrays": [(name, array.dtype.str) for name, array in self._stored_arrays()]
+            }
+        num_in_buffer = header["num_in_buffer"]
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            self._write_record(f, header)
+            for start in range(0, num_in_buffer, chunk_size):
+                end = min(start + chunk_size, num_in_buffer)
+                with self._write_lock:
+                    chunks = [
+                        np.ascontiguousarray(array[start:end])
+                        for _, array in self._stored_arrays()]
+                self._write_chunks(f, chunks, compress)
+
+            # episodes pushed during the save are split between the chunks
+            # copied before and after them, slots written since the start
+            # are copied again together with the final counters, so the
+            # snapshot is the state of the buffer at this moment
+            with self._write_lock:
+                num_written = min(self.stored_in_buffer - header["stored_in_buffer"], self.size)
+                trailer = {
+                    "pointer": self.pointer,
+                    "num_in_buffer": self.num_in_buffer,
+                    "stored_in_buffer": self.stored_in_buffer,
+                    "max_priority": float(getattr(self, "_max_priority", 1.0)),
+                    "written_start": header["pointer"],
+                    "num_written": num_written
+                }
+                written = (header["pointer"] + np.arange(num_written)) % self.size
+                written_chunks = [array[written] for _, array in self._stored_arrays()]
+            self._write_record(f, trailer)
+            for start in range(0, num_written, chunk_size):
+                self._write_chunks(
+                    f, [chunk[start:start + chunk_size] for chunk in written_chunks], compress)
+        os.replace(tmp_path, path)
+        print("--- replay buffer saved in file: {}".format(path))
+
+    @staticmethod
+    def _write_record(f, record):
+        data = json.dumps(record).encode()
+        f.write(struct.pack("<L", len(data)) + data)
+
+    @staticmethod
+    def _read_record(f):
+        """ json record, None at the end of the file
+        """
+        data_len = f.read(4)
+        if len(data_len) < 4:
+            return None
+        return json.loads(f.read(struct.unpack("<L", data_len)[0]).decode())
+
+    @staticmethod
+    def _write_chunks(f, chunks, compress):
+        for chunk in chunks:
+            data = chunk.tobytes()
+            if compress:
+                data = zlib.compress(data, 1)
+            f.write(struct.pack("<Q", len(data)) + data)
+
+    @staticmethod
+    def _read_chunks(f, arrays, indices, compress):
+        for array in arrays:
+            data_len = struct.unpack("<Q", f.read(8))[0]
+            data = f.read(data_len)
+            if compress:
+                data = zlib.decompress(data)
+            array[indices] = np.frombuffer(
+                data, dtype=array.dtype).reshape((len(indices), ) + array.shape[1:])
+
+    def load(self, path, verbose=True):
+        """ Restore the buffer from the snapshot written by save.
+        """
+        with open(path, "rb") as f, self._write_lock, self._store_lock:
+            header = self._read_record(f)
+            stored_shapes = [tuple(shape) for shape in header["observation_shapes"]]
+            arrays = [array for _, array in self._stored_arrays()]
+            if (header["capacity"] != self.size or stored_shapes != self.obs_shapes
+                    or tuple(header["action_shape"]) != self.act_shape
+                    or [dtype for _, dtype in header["arrays"]] != [a.dtype.str for a in arrays]):
+                raise ValueError(
+                    "replay buffer snapshot {} does not match the buffer".format(path))
+
+            if self.lock_free:
+                # samplers resample everything they read during the load
+                self._segment_seqs += 1
+            chunk_size = header["chunk_size"]
+            for start in range(0, header["num_in_buffer"], chunk_size):
+                end = min(start + chunk_size, header["num_in_buffer"])
+                self._read_chunks(f, arrays, np.arange(start, end), header["compress"])
+
+            # slots written during the save and the final counters,
+            # snapshots of older versions have no trailer
+            trailer = self._read_record(f)
+            if trailer is not None:
+                written = (trailer["written_start"] + np.arange(trailer["num_written"])) % self.size
+                for start in range(0, len(written), chunk_size):
+                    self._read_chunks(
+                        f, arrays, written[start:start + chunk_size], header["compress"])
+                header.update(trailer)
+
+            self.pointer = header["pointer"]
+            self.num_in_buffer = header["num_in_buffer"]
+            self.stored_in_buffer = header["stored_in_buffer"]
+            if self.lock_free:
+                self._segment_seqs += 1
+            if self.prioritized:
+                self._sum_tree = SumTree(self.size)
+                self._min_tree = MinTree(self.size)
+                self._max_priority = header["max_priority"]
+                self._restore_priorities()
+            # precomputed n-step returns are rebuilt from the loaded data
+            for (n_step, gamma), n_step_returns in self._n_step_returns.items():
+                self._fill_n_step_returns(n_step_returns, n_step, gamma)
+            if self.storage_path is not None:
+                self._write_header()
+        if verbose:
+            print("--- replay buffer with {} transitions loaded from file: {}".format(
+                self.num_in_buffer, path))
 
     def push_episode(self, episode):
         """ episode = [observations, actions, rewards, dones]
+            or [observations, actions, rewards, dones, recurrent_states]
             observations = [obs_part_1, ..., obs_part_n]
         """
 
-        with self._store_lock:
+        with self._write_lock:
 
-            observations, actions, rewards, dones = episode
+            observations, actions, rewards, dones = episode[:4]
             episode_len = len(actions)
-            self.stored_in_buffer += episode_len
-            self.num_in_buffer = min(self.size, self.num_in_buffer + episode_len)
 
             indices = np.arange(self.pointer, self.pointer + episode_len) % self.size
+            if self.cold_storage is not None:
+                # the oldest transitions which are going to be overwritten
+                num_evicted = min(episode_len, self.num_in_buffer + episode_len - self.size)
+                if num_evicted > 0:
+                    self.cold_storage.evict(self, indices[episode_len - num_evicted:])
+            if self.lock_free:
+                segments = np.unique(indices // self.segment_size)
+                self._segment_seqs[segments] += 1
+
             for part_id in range(self.num_parts):
-                self.observations[part_id][indices] = np.array(observations[part_id])
-            self.actions[indices] = np.array(actions)
+                self.observations[part_id][indices] = self.obs_codecs[part_id].encode(observations[part_id])
+            self.actions[indices] = self.act_codec.encode(actions)
             self.rewards[indices] = np.array(rewards)
             self.dones[indices] = np.array(dones)
             self.td_errors[indices] = np.ones(len(indices))
+            self.episode_offsets[indices] = np.arange(episode_len)
+            if self.recurrent_states is not None:
+                if len(episode) > 4:
+                    self.recurrent_states[indices] = episode[4]
+                else:
+                    self.recurrent_states[indices] = 0
+            if self.prioritized:
+                with self._store_lock:
+                    self._prioritize_new(indices)
+            for (n_step, gamma), n_step_returns in self._n_step_returns.items():
+                returns = self.get_episode_n_step_returns(rewards, dones, n_step, gamma)
+                for array, values in zip(n_step_returns, returns):
+                    array[indices] = values
+
+            if self.lock_free:
+                self._segment_seqs[segments] += 1
 
+            # commit, new slots are visible to samplers only from now on
+            self.num_in_buffer = min(self.size, self.num_in_buffer + episode_len)
             self.pointer = (self.pointer + episode_len) % self.size
+            self.stored_in_buffer += episode_len
+            if self.storage_path is not None:
+                self._pushes_since_header += 1
+                if self._pushes_since_header >= self.header_period:
+                    self._write_header()
 
     def get_stored_in_buffer(self):
         return self.stored_in_buffer
@@ -59,86 +630,469 @@ class ServerBuffer:
     def get_state(self, idx, history_len=1):
         """ compose the state from a number (history_len) of observations
         """
-        state = []
+        states = self.get_states(np.array([idx]), history_len)
+        return [s[0] for s in states]
+
+    def get_ages(self, indices):
+        """ number of transitions stored before the given ones,
+            previous slots beyond it are already overwritten
+        """
+        return (indices - self.pointer) % self.size if self.num_in_buffer == self.size else indices
+
+    def get_states(self, indices, history_len=1):
+        """ compose the states for a batch of indices at once,
+            observations from the previous episodes are zero-padded
+        """
+        return self.get_state_windows(indices, history_len)
+
+    def get_state_windows(self, indices, history_len=1, n_step=0, offsets=None,
+                          out=None, scratch=None):
+        """ compose windows of observations from idx - history_len + 1
+            up to idx + n_step, observations from the previous episodes
+            and after the last given steps (episode end) are zero-padded,
+            windows are written to out parts if given
+        """
+        steps = np.arange(-history_len + 1, n_step + 1)
+        window = (indices[:, None] + steps[None, :]) % self.size
+
+        # only observations of the same episode which are not overwritten yet
+        limit = np.minimum(self.episode_offsets[indices], self.get_ages(indices))
+        mask = steps[None, :] >= -limit[:, None]
+        if n_step > 0:
+            mask &= steps[None, :] <= offsets[:, None]
+
+        out = out if out is not None else [None] * self.num_parts
+        scratch = scratch if scratch is not None else [None] * self.num_parts
+        states = []
         for part_id in range(self.num_parts):
-            start_idx = idx - history_len + 1
-
-            if (start_idx < 0 or np.any(self.dones[start_idx:idx+1])):
-                s = np.zeros((history_len, ) + self.obs_shapes[part_id], dtype=np.float32)
-                indices = [idx]
-                for i in range(history_len-1):
-                    next_idx = (idx-i-1) % self.size
-                    if next_idx >= self.num_in_buffer or self.dones[next_idx]:
-                        break
-                    indices.append(next_idx)
-                indices = indices[::-1]
-                s[-len(indices):] = self.observations[part_id][indices]
-            else:
-                s = self.observations[part_id][slice(start_idx, idx+1, 1)]
-                
-            state.append(s)
-        return state
+            s = self._gather(
+                self.observations[part_id], self.obs_codecs[part_id],
+                window, out[part_id], scratch[part_id])
+            s[~mask] = 0
+            states.append(s)
+        return states
+
+    @staticmethod
+    def _gather(array, codec, indices, out=None, scratch=None):
+        """ decoded array[indices], in place if out is given,
+            scratch of the storage dtype avoids the temporary copy
+            of the values which are not stored as float32
+        """
+        if out is None:
+            return codec.decode(array[indices])
+        if codec.dtype == np.float32:
+            return np.take(array, indices, axis=0, out=out, mode="clip")
+        if scratch is None:
+            return codec.decode(array[indices], out)
+        return codec.decode(np.take(array, indices, axis=0, out=scratch, mode="clip"), out)
 
     def get_transition_n_step(self, idx, history_len=1, n_step=1, gamma=0.99):
-        state = self.get_state(idx, history_len)
-        next_state = self.get_state((idx + n_step) % self.size, history_len)
-        cum_reward = 0
-        indices = np.arange(idx, idx + n_step) % self.size
-        for num, i in enumerate(indices):
-            cum_reward += self.rewards[i] * (gamma ** num)
-            done = self.dones[i]
-            if done:
-                break
-        return state, self.actions[idx], cum_reward, next_state, done, self.td_errors[idx]
-
-    def update_td_errors(self, indices, td_errors):
-        self.td_errors[indices] = td_errors
-
-    def get_batch(self, batch_size, history_len=1, n_step=1, gamma=0.99, indices=None):
+        batch = self.get_batch(1, history_len, n_step, gamma, np.array([idx]))
+        state = [s[0] for s in batch.s]
+        next_state = [s[0] for s in batch.s_]
+        return state, batch.a[0], batch.r[0], next_state, batch.done[0], self.td_errors[idx]
+
+    def get_n_step_returns(self, indices, n_step=1, gamma=0.99):
+        """ n-step returns of the stored transitions computed over the ring,
+            used to fill precomputed arrays for the already stored data
+        """
+        forward = np.arange(n_step)[None, :]
+        steps = (indices[:, None] + forward) % self.size
+        # step belongs to the same episode and does not cross the newest transition
+        valid = self.episode_offsets[steps] == self.episode_offsets[indices][:, None] + forward
+        valid &= self.get_ages(indices)[:, None] + forward < self.num_in_buffer
+        return discounted_n_step_returns(
+            self.rewards[steps], self.dones[steps], valid, gamma)
+
+    def get_episode_n_step_returns(self, rewards, dones, n_step=1, gamma=0.99):
+        """ n-step returns of the whole episode which is being inserted
+        """
+        rewards = np.asarray(rewards, dtype=np.float32)
+        dones = np.asarray(dones, dtype=np.bool)
+        episode_len = len(rewards)
+        steps = np.arange(episode_len)[:, None] + np.arange(n_step)[None, :]
+        valid = steps < episode_len
+        steps = np.minimum(steps, episode_len - 1)
+        return discounted_n_step_returns(rewards[steps], dones[steps], valid, gamma)
+
+    def _allocate_n_step_returns(self, n_step, gamma):
+        return NStepReturns(
+            np.zeros((self.size, ), dtype=np.float32),
+            np.zeros((self.size, ), dtype=np.int32),
+            np.zeros((self.size, ), dtype=np.bool))
+
+    def register_n_step(self, n_step=1, gamma=0.99):
+        """ allocate arrays of precomputed n-step returns for (n_step, gamma)
+            and fill them for the transitions which are already stored
+        """
+        key = (n_step, gamma)
+        if key in self._n_step_returns:
+            return self._n_step_returns[key]
+        with self._write_lock:
+            if key not in self._n_step_returns:
+                n_step_returns = self._allocate_n_step_returns(n_step, gamma)
+                if self._prefault:
+                    for array in n_step_returns:
+                        self._prefault_array(array)
+                self._fill_n_step_returns(n_step_returns, n_step, gamma)
+                self._n_step_returns[key] = n_step_returns
+            return self._n_step_returns[key]
+
+    def _fill_n_step_returns(self, n_step_returns, n_step, gamma):
+        indices = np.arange(self.num_in_buffer)
+        returns = self.get_n_step_returns(indices, n_step, gamma)
+        for array, values in zip(n_step_returns, returns):
+            array[indices] = values
+
+    def update_td_errors(self, indices, td_errors, generations=None):
+        """ update priorities, if generations returned with the prioritized
+            batch are given, slots which were overwritten since are skipped
+        """
+        with self._store_lock:
+            if generations is not None:
+                fresh = self.generations[indices] == generations
+                self.stale_td_updates += int(len(fresh) - fresh.sum())
+                indices, td_errors = indices[fresh], td_errors[fresh]
+                if len(indices) == 0:
+                    return
+            self.td_errors[indices] = td_errors
+            if self.prioritized:
+                priorities = np.abs(td_errors) + 1e-6
+                self._max_priority = max(self._max_priority, priorities.max())
+                self._sum_tree[indices] = priorities ** self.alpha
+                self._min_tree[indices] = priorities ** self.alpha
+                self._rank_updates += 1
+
+    def get_batch(self, batch_size, history_len=1, n_step=1, gamma=0.99,
+                  indices=None, window=False, out=None):
+        """ sample a batch of transitions, returns Transition or,
+            if window is True, WindowTransition with overlapping states
+            and next states (bootstrap state is assumed to be n_step ahead),
+            the batch is written to out if given
+        """
+
+        if self.cold_storage is not None and indices is None and out is None:
+            cold_size = self.cold_storage.get_sample_size(batch_size)
+            if cold_size > 0:
+                return self._get_tiered_batch(
+                    batch_size, cold_size, history_len, n_step, gamma, window)
+
+        if self.lock_free:
+            return self._get_batch_lock_free(
+                batch_size, history_len, n_step, gamma, indices, window, out=out)
 
         with self._store_lock:
+            return self._gather_batch(
+                batch_size, history_len, n_step, gamma, indices, window, out=out)
 
-            if indices is None:
-                indices = random.sample(range(self.num_in_buffer), k=batch_size)
-            transitions = []
-            for idx in indices:
-                transition = self.get_transition_n_step(idx, history_len, n_step, gamma)
-                transitions.append(transition)
+    def register_batch_buffers(self, batch_size, history_len=1, n_step=1,
+                               window=False, num_buffers=2):
+        """ preallocate num_buffers batches which get_batch fills in place
+            and returns round-robin for these batch parameters, so sampling
+            makes no large allocations in the steady state. Returned batch
+            is overwritten after num_buffers more batches of the same kind
+        """
+        self._batch_buffers.register((batch_size, history_len, n_step, window), num_buffers)
 
-            states = []
-            for part_id in range(self.num_parts):
-                state = [transitions[i][0][part_id] for i in range(batch_size)]
-                states.append(state)
-            actions = [transitions[i][1] for i in range(batch_size)]
-            rewards = [transitions[i][2] for i in range(batch_size)]
-            next_states = []
-            for part_id in range(self.num_parts):
-                next_state = [transitions[i][3][part_id] for i in range(batch_size)]
-                next_states.append(next_state)
-            dones = [transitions[i][4] for i in range(batch_size)]
-
-            batch = Transition(
-                np.array(states, dtype=np.float32),
-                np.array(actions, dtype=np.float32),
-                np.array(rewards, dtype=np.float32),
-                np.array(next_states, dtype=np.float32),
-                np.array(dones, dtype=np.bool)
-            )
+    def _allocate_batch(self, batch_size, history_len, n_step, window):
+        """ empty batch and scratch arrays for the encoded storage dtypes
+        """
+        state_len = history_len + n_step if window else history_len
+
+        def states():
+            # parts of the same shape are stacked, otherwise they are a list
+            if len(set(self.obs_shapes)) == 1:
+                return np.zeros(
+                    (self.num_parts, batch_size, state_len) + self.obs_shapes[0],
+                    dtype=np.float32)
+            return [
+                np.zeros((batch_size, state_len) + shape, dtype=np.float32)
+                for shape in self.obs_shapes]
+
+        a = np.zeros((batch_size, ) + self.act_shape, dtype=np.float32)
+        r = np.zeros((batch_size, ), dtype=np.float32)
+        done = np.zeros((batch_size, ), dtype=np.bool)
+        if window:
+            batch = WindowTransition(states(), a, r, done)
+        else:
+            batch = Transition(states(), a, r, states(), done)
+
+        obs_scratch = [
+            None if codec.dtype == np.float32 else
+            np.zeros((batch_size, state_len) + shape, dtype=codec.dtype)
+            for codec, shape in zip(self.obs_codecs, self.obs_shapes)]
+        act_scratch = None
+        if self.act_codec.dtype != np.float32:
+            act_scratch = np.zeros((batch_size, ) + self.act_shape, dtype=self.act_codec.dtype)
+        return batch, obs_scratch, act_scratch
+
+    def _next_batch(self, batch_size, history_len, n_step, window, pooled=True):
+        return self._batch_buffers.next((batch_size, history_len, n_step, window), pooled)
+
+    def _get_tiered_batch(self, batch_size, cold_size, history_len, n_step, gamma, window):
+        """ first rows of the batch are from the ring, the last cold_size from the cold tier
+        """
+        batch = self._next_batch(batch_size, history_len, n_step, window)[0]
+        hot_size = batch_size - cold_size
+        indices = np.array(random.sample(range(self.num_in_buffer), k=hot_size))
+        self.get_batch(
+            hot_size, history_len, n_step, gamma, indices, window,
+            out=batch_rows(batch, 0, hot_size))
+        self.cold_storage.sample(
+            cold_size, history_len, n_step, gamma, window,
+            batch_rows(batch, hot_size, batch_size))
+        return batch
+
+    def _gather_batch(self, batch_size, history_len, n_step, gamma, indices,
+                      window=False, pooled=True, out=None):
+
+        if indices is None:
+            indices = random.sample(range(self.num_in_buffer), k=batch_size)
+        indices = np.asarray(indices)
+
+        n_step_returns = self.register_n_step(n_step, gamma)
+        offsets = n_step_returns.offsets[indices]
+
+        if out is not None:
+            batch, obs_scratch, act_scratch = out, None, None
+        else:
+            batch, obs_scratch, act_scratch = self._next_batch(
+                len(indices), history_len, n_step, window, pooled)
+        self._gather(self.actions, self.act_codec, indices, batch.a, act_scratch)
+        np.take(n_step_returns.returns, indices, out=batch.r, mode="clip")
+        np.take(n_step_returns.dones, indices, out=batch.done, mode="clip")
+
+        if window:
+            # terminal transitions have no bootstrap state, the slot after
+            # the done belongs to the next episode (or is not written yet)
+            last_steps = offsets - batch.done
+            self.get_state_windows(
+                indices, history_len, n_step, last_steps, batch.s_window, obs_scratch)
             return batch
 
+        next_indices = (indices + offsets) % self.size
+        self.get_state_windows(indices, history_len, out=batch.s, scratch=obs_scratch)
+        self.get_state_windows(next_indices, history_len, out=batch.s_, scratch=obs_scratch)
+        return batch
+
+    def _window_segments(self, indices, history_len, n_step):
+        """ segments of every slot from idx - history_len + 1 up to idx + n_step
+        """
+        steps = np.arange(-history_len + 1, n_step + 1)
+        return ((indices[:, None] + steps[None, :]) % self.size) // self.segment_size
+
+    def _get_batch_lock_free(self, batch_size, history_len, n_step, gamma, indices,
+                             window=False, pooled=True, out=None):
+
+        resample = indices is None
+        if resample:
+            indices = random.sample(range(self.num_in_buffer), k=batch_size)
+        indices = np.asarray(indices)
+
+        # transition reads slots from idx - history_len + 1 up to idx + n_step,
+        # a window wrapped around a short last segment spans three of them
+        segments = self._window_segments(indices, history_len, n_step)
+        seqs_before = self._segment_seqs[segments]
+        batch = self._gather_batch(
+            batch_size, history_len, n_step, gamma, indices, window, pooled, out)
+        seqs_after = self._segment_seqs[segments]
+
+        torn = np.any((seqs_before != seqs_after) | (seqs_before % 2 == 1), axis=1)
+        if np.any(torn):
+            # overwritten while gathered, resample them (or reread given indices),
+            # retry does not take pooled buffers which may be still in use
+            retry = self._get_batch_lock_free(
+                int(torn.sum()), history_len, n_step, gamma,
+                None if resample else indices[torn], window, pooled=False)
+            for name in batch._fields:
+                # states are given per observation part
+                if name in ("s", "s_", "s_window"):
+                    for part, retry_part in zip(getattr(batch, name), getattr(retry, name)):
+                        part[torn] = retry_part
+                else:
+                    getattr(batch, name)[torn] = getattr(retry, name)
+        return batch
+
+    def get_batches(self, num_batches, batch_size, history_len=1, n_step=1,
+                    gamma=0.99, window=False, stacked=False):
+        """ sample several batches at once: indices of all of them are drawn
+            by one generator call (with replacement) and gathered under one
+            lock acquisition. Returns the list of batches or, if stacked,
+            one batch of num_batches * batch_size transitions where
+            batch i takes rows i * batch_size up to (i + 1) * batch_size
+        """
+
+        if self.lock_free:
+            return self._get_batches(
+                num_batches, batch_size, history_len, n_step, gamma, window, stacked)
+
+        with self._store_lock:
+            return self._get_batches(
+                num_batches, batch_size, history_len, n_step, gamma, window, stacked)
+
+    def _get_batches(self, num_batches, batch_size, history_len, n_step, gamma, window, stacked):
+        indices = self._rng.integers(self.num_in_buffer, size=(num_batches, batch_size))
+        gather = self._get_batch_lock_free if self.lock_free else self._gather_batch
+        if stacked:
+            return gather(
+                num_batches * batch_size, history_len, n_step, gamma, indices.ravel(), window)
+        key = (batch_size, history_len, n_step, window)
+        pooled = self._batch_buffers.can_pool(key, num_batches)
+        return [
+            gather(batch_size, history_len, n_step, gamma, batch_indices, window, pooled)
+            for batch_indices in indices]
+
+    def get_sequence_batch(self, batch_size, sequence_len, burn_in=0,
+                           n_step=1, gamma=0.99, indices=None):
+        """ sample contiguous sequences of burn_in + sequence_len steps which
+            start at the sampled slots. Steps after the end of the episode
+            are zero-padded and masked out, observations include n_step more
+            steps for the bootstrap states (at step + offsets). The first
+            burn_in steps only recompute the recurrent state, initial_state
+            is the state stored before the first step if the buffer keeps
+            recurrent states (recurrent_state_size), None otherwise
+        """
+
+        if self.lock_free:
+            return self._get_sequence_batch_lock_free(
+                batch_size, sequence_len, burn_in, n_step, gamma, indices)
+
+        with self._store_lock:
+            return self._gather_sequence_batch(
+                batch_size, sequence_len, burn_in, n_step, gamma, indices)
+
+    def _gather_sequence_batch(self, batch_size, sequence_len, burn_in, n_step, gamma, indices):
+
+        if indices is None:
+            indices = self._rng.integers(self.num_in_buffer, size=batch_size)
+        indices = np.asarray(indices)
+        n_step_returns = self.register_n_step(n_step, gamma)
+
+        length = burn_in + sequence_len
+        steps = np.arange(length + n_step)
+        slots = (indices[:, None] + steps[None, :]) % self.size
+        # slot belongs to the same episode and does not cross the newest transition
+        valid = self.episode_offsets[slots] == self.episode_offsets[indices][:, None] + steps
+        valid &= self.get_ages(indices)[:, None] + steps < self.num_in_buffer
+
+        states = []
+        for part_id in range(self.num_parts):
+            s = self._gather(self.observations[part_id], self.obs_codecs[part_id], slots)
+            s[~valid] = 0
+            states.append(s)
+
+        mask = valid[:, :length]
+        step_slots = slots[:, :length]
+        actions = self._gather(self.actions, self.act_codec, step_slots)
+        actions[~mask] = 0
+        initial_state = None
+        if self.recurrent_states is not None:
+            initial_state = self.recurrent_states[indices]
+
+        return SequenceTransition(
+            states,
+            actions,
+            n_step_returns.returns[step_slots] * mask,
+            n_step_returns.dones[step_slots] & mask,
+            n_step_returns.offsets[step_slots] * mask,
+            mask,
+            initial_state
+        )
+
+    def _get_sequence_batch_lock_free(self, batch_size, sequence_len, burn_in,
+                                      n_step, gamma, indices):
+
+        resample = indices is None
+        if resample:
+            indices = self._rng.integers(self.num_in_buffer, size=batch_size)
+        indices = np.asarray(indices)
+
+        # sequence may span any number of segments
+        segments = self._window_segments(indices, 1, burn_in + sequence_len + n_step - 1)
+        seqs_before = self._segment_seqs[segments]
+        batch = self._gather_sequence_batch(
+            batch_size, sequence_len, burn_in, n_step, gamma, indices)
+        seqs_after = self._segment_seqs[segments]
+
+        torn = np.any((seqs_before != seqs_after) | (seqs_before % 2 == 1), axis=1)
+        if np.any(torn):
+            retry = self._get_sequence_batch_lock_free(
+                int(torn.sum()), sequence_len, burn_in, n_step, gamma,
+                None if resample else indices[torn])
+            for part, retry_part in zip(batch.s, retry.s):
+                part[torn] = retry_part
+            for name in batch._fields[1:]:
+                if getattr(batch, name) is not None:
+                    getattr(batch, name)[torn] = getattr(retry, name)
+        return batch
+
     def get_prioritized_batch(self, batch_size, history_len=1,
                               n_step=1, gamma=0.99,
-                              priority="proportional", alpha=0.6, beta=1.0):
+                              priority="proportional", beta=1.0, window=False, out=None):
+        """ sample a batch with probabilities given by priorities,
+            priority is "proportional" (to |td error|^alpha, sum tree)
+            or "rank" (to rank^-alpha in the lazily sorted order),
+            returns batch, indices, importance sampling weights
+            (w_i = (N * P(i))^-beta divided by the max weight in the buffer) and
+            generations of the slots to pass to update_td_errors,
+            the batch is written to out if given
+        """
 
         with self._store_lock:
 
             if priority == "proportional":
-                p = np.power(np.abs(self.td_errors[:self.num_in_buffer])+1e-6, alpha)
-                p = p / p.sum()
-                indices = np.random.choice(range(self.num_in_buffer), size=batch_size, p=p)
-                probs = p[indices]
-                is_weights = np.power(self.num_in_buffer * probs, -beta)
-                is_weights = is_weights / is_weights.max()
-
-            batch = self.get_batch(batch_size, history_len, n_step, gamma, indices)
-            return batch, indices, is_weights
+                # stratified sampling, one prefix sum from every segment
+                p_total = self._sum_tree.sum()
+                segment = p_total / batch_size
+                prefixsums = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+                indices = self._sum_tree.find_prefixsum_idx(prefixsums)
+                indices = np.minimum(indices, self.num_in_buffer - 1)
+                probs = self._sum_tree[indices] / p_total
+                min_prob = self._min_tree.min() / p_total
+            elif priority == "rank":
+                indices, probs, min_prob = self._sample_rank_based(batch_size)
+            else:
+                raise NotImplementedError(priority)
+            # weights are normalized by the max weight over the whole buffer
+            # (of the least probable transition), not over the batch
+            is_weights = np.power(probs / min_prob, -beta)
+            generations = self.generations[indices]
+
+        batch = self.get_batch(batch_size, history_len, n_step, gamma, indices, window, out)
+        return batch, indices, is_weights, generations
+
+    def _sample_rank_based(self, batch_size):
+        """ P(i) ~ rank(i)^-alpha, ranks are split into batch_size buckets
+            of equal probability mass and one rank is taken uniformly from
+            every bucket, the rank order is recomputed every rank_sort_period
+            updates or when the number of stored transitions doubles, slots
+            written since take the top ranks as with max priority insertion
+        """
+        if self._ranked is None or self._rank_updates >= self.rank_sort_period \
+                or self.num_in_buffer >= 2 * len(self._ranked):
+            priorities = np.abs(self.td_errors[:self.num_in_buffer])
+            self._ranked = np.argsort(-priorities, kind="stable")
+            self._rank_updates = 0
+            self._rank_fresh = []
+        elif self._rank_fresh:
+            fresh = np.unique(np.concatenate(self._rank_fresh))
+            is_fresh = np.zeros(self.size, dtype=np.bool)
+            is_fresh[fresh] = True
+            self._ranked = np.concatenate([fresh, self._ranked[~is_fresh[self._ranked]]])
+            self._rank_fresh = []
+
+        num_ranks = len(self._ranked)
+        if self._rank_buckets is None or self._rank_buckets[0] != (num_ranks, batch_size):
+            cdf = np.cumsum(np.arange(1, num_ranks + 1, dtype=np.float64) ** -self.alpha)
+            cdf /= cdf[-1]
+            bounds = np.searchsorted(cdf, np.arange(batch_size) / batch_size, side="right")
+            low = np.minimum(bounds, num_ranks - 1)
+            # top ranks may take more than one bucket of mass
+            width = np.maximum(np.append(bounds[1:], num_ranks) - low, 1)
+            self._rank_buckets = ((num_ranks, batch_size), low, width)
+
+        _, low, width = self._rank_buckets
+        ranks = low + (np.random.rand(batch_size) * width).astype(np.int64)
+        probs = 1. / (batch_size * width)
+        # ranks of the widest bucket are the least probable ones
+        return self._ranked[ranks], probs, 1. / (batch_size * width.max())
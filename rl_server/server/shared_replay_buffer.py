@@ -0,0 +1,191 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from rl_server.server.server_replay_buffer import ServerBuffer, NStepReturns
+
+
+def shared_array(block_name, shape, dtype, create=True):
+    """ array in the shared memory block, which is either created
+        (and zeroed) or attached to, returns the array and the block
+    """
+    nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    if create:
+        block = shared_memory.SharedMemory(name=block_name, create=True, size=nbytes)
+    else:
+        try:
+            # the block is owned by the creator, python >= 3.13
+            # can be told not to free it when the process exits
+            block = shared_memory.SharedMemory(name=block_name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=block_name)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    if create:
+        array.fill(0)
+    return array, block
+
+
+class SharedServerBuffer(ServerBuffer):
+
+    def __init__(self, name, capacity, observation_shapes, action_size,
+                 create=True, segment_size=1024,
+                 observation_codecs=None, action_codec=None,
+                 prioritized=False, alpha=0.6, rank_sort_period=1000):
+        """ Replay buffer which lives in multiprocessing.shared_memory,
+            so one writer process pushes episodes and any number of sampler
+            processes attached by name read batches without copying.
+
+            Consistency protocol is the one of the lock-free ServerBuffer:
+            the ring is split into segments of segment_size slots, each with
+            a sequence number. The writer makes the numbers of the segments it
+            writes odd before writing and even again after, then publishes the
+            counters. Samplers read only published slots and resample
+            transitions whose segments were written while the batch was
+            gathered (seqlock).
+
+        Parameters
+        ----------
+        name: str
+            prefix of the shared memory blocks
+        create: bool
+            True for the writer which creates the blocks,
+            False for samplers which attach to the existing ones
+        segment_size: int
+            number of slots guarded by one sequence number, must be
+            greater than history_len + n_step
+        prioritized: bool
+            samplers only, priorities are kept by the one sampler which
+            gets prioritized batches, slots written by the writer get the
+            max priority when the sampler sees them
+        """
+        assert not (create and prioritized), "priorities are kept by the sampler"
+        self.name = name
+        self.create = create
+        self.segment_size = segment_size
+        self._shared_blocks = []
+        # pointer, num_in_buffer, stored_in_buffer
+        self._counters = self._shared_array("counters", (3, ), np.int64)
+        super().__init__(
+            capacity, observation_shapes, action_size,
+            observation_codecs=observation_codecs,
+            action_codec=action_codec,
+            lock_free=True,
+            segment_size=segment_size,
+            prioritized=prioritized,
+            alpha=alpha,
+            rank_sort_period=rank_sort_period)
+        # stored_in_buffer of the writer when priorities were last synced
+        self._prioritized_stored = 0
+        if not self.create:
+            self._sync_counters()
+            if self.prioritized:
+                # sampler restarted (e.g. for a new batch size) continues
+                # with the priorities of the td errors in the shared buffer
+                self._restore_priorities()
+                self._prioritized_stored = self.stored_in_buffer
+
+    def _shared_array(self, name, shape, dtype):
+        array, block = shared_array(
+            "{}_{}".format(self.name, name), shape, dtype, self.create)
+        self._shared_blocks.append(block)
+        return array
+
+    def _allocate(self, name, shape, dtype):
+        return self._shared_array(name, (self.size, ) + tuple(shape), dtype)
+
+    def _allocate_segment_seqs(self, num_segments):
+        return self._shared_array("segment_seqs", (num_segments, ), np.int64)
+
+    def _allocate_n_step_returns(self, n_step, gamma):
+        name = "n_step_{}_{}".format(n_step, gamma)
+        return NStepReturns(
+            self._shared_array(name + "_returns", (self.size, ), np.float32),
+            self._shared_array(name + "_offsets", (self.size, ), np.int32),
+            self._shared_array(name + "_dones", (self.size, ), np.bool))
+
+    def _sync_counters(self):
+        self.pointer, self.num_in_buffer, self.stored_in_buffer = self._counters.tolist()
+
+    def register_n_step(self, n_step=1, gamma=0.99):
+        """ samplers attach to the arrays registered by the writer
+        """
+        if self.create:
+            return super().register_n_step(n_step, gamma)
+        key = (n_step, gamma)
+        if key not in self._n_step_returns:
+            self._n_step_returns[key] = self._allocate_n_step_returns(n_step, gamma)
+        return self._n_step_returns[key]
+
+    def push_episode(self, episode):
+        assert self.create, "only the writer can push episodes"
+        with self._write_lock:
+            super().push_episode(episode)
+            self._publish_counters()
+
+    def load(self, path, verbose=True):
+        assert self.create, "only the writer can load the snapshot"
+        with self._write_lock:
+            super().load(path, verbose)
+            self._publish_counters()
+
+    def _publish_counters(self):
+        self._counters[:] = [self.pointer, self.num_in_buffer, self.stored_in_buffer]
+
+    def get_stored_in_buffer(self):
+        if not self.create:
+            self._sync_counters()
+        return self.stored_in_buffer
+
+    def get_batch(self, batch_size, history_len=1, n_step=1, gamma=0.99,
+                  indices=None, window=False, out=None):
+        if not self.create:
+            self._sync_counters()
+        return super().get_batch(batch_size, history_len, n_step, gamma, indices, window, out)
+
+    def get_batches(self, num_batches, batch_size, history_len=1, n_step=1,
+                    gamma=0.99, window=False, stacked=False):
+        if not self.create:
+            self._sync_counters()
+        return super().get_batches(
+            num_batches, batch_size, history_len, n_step, gamma, window, stacked)
+
+    def _sync_priorities(self):
+        """ slots written since the last sync get the max priority
+        """
+        num_new = min(self.stored_in_buffer - self._prioritized_stored, self.size)
+        if num_new > 0:
+            indices = np.arange(self.pointer - num_new, self.pointer) % self.size
+            with self._store_lock:
+                self._prioritize_new(indices)
+        self._prioritized_stored = self.stored_in_buffer
+
+    def update_td_errors(self, indices, td_errors, generations=None):
+        if not self.create and self.prioritized:
+            # generations of the slots written since the last sync are bumped
+            # first, so td errors of their previous transitions are dropped
+            self._sync_counters()
+            self._sync_priorities()
+        super().update_td_errors(indices, td_errors, generations)
+
+    def get_prioritized_batch(self, *args, **kwargs):
+        if self.create or not self.prioritized:
+            raise NotImplementedError(
+                "priorities are not shared between processes, they are "
+                "kept by one sampler created with prioritized=True")
+        self._sync_counters()
+        self._sync_priorities()
+        return super().get_prioritized_batch(*args, **kwargs)
+
+    def close(self):
+        """ detach from the shared memory, the writer also frees it
+        """
+        self._n_step_returns = {}
+        self.observations = []
+        self.actions = self.rewards = self.dones = None
+        self.td_errors = self.episode_offsets = None
+        self._counters = self._segment_seqs = None
+        for block in self._shared_blocks:
+            block.close()
+            if self.create:
+                block.unlink()
+        self._shared_blocks = []
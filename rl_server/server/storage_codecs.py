@@ -0,0 +1,147 @@
+import numpy as np
+
+
+class Float32Codec:
+    """ Stores values as is.
+    """
+    dtype = np.float32
+
+    def encode(self, values):
+        return np.asarray(values, dtype=np.float32)
+
+    def decode(self, values, out=None):
+        if out is None:
+            return np.asarray(values, dtype=np.float32)
+        np.copyto(out, values)
+        return out
+
+
+class Float16Codec:
+    """ Stores values in half precision, halves the memory.
+    """
+    dtype = np.float16
+
+    def encode(self, values):
+        return np.asarray(values, dtype=np.float16)
+
+    def decode(self, values, out=None):
+        if out is None:
+            return values.astype(np.float32)
+        np.copyto(out, values)
+        return out
+
+
+class RawCodec:
+    """ Stores values in their native dtype, e.g. uint8 image pixels.
+    """
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype).type
+
+    def encode(self, values):
+        return np.asarray(values, dtype=self.dtype)
+
+    def decode(self, values, out=None):
+        if out is None:
+            return values.astype(np.float32)
+        np.copyto(out, values)
+        return out
+
+
+class LinearQuantizationCodec:
+
+    def __init__(self, shape, dtype=np.int8, low=-1., high=1.):
+        """ Stores values as 8-bit integers with per-feature scale and offset.
+
+        Parameters
+        ----------
+        shape: tuple
+            shape of the stored value (observation or action)
+        dtype: np.int8 or np.uint8
+            integer type of the storage
+        low, high: float or np.array broadcastable to shape
+            range of the values, everything outside is clipped
+        """
+        self.dtype = np.dtype(dtype).type
+        info = np.iinfo(self.dtype)
+        self._qmin, self._qmax = info.min, info.max
+        low = np.broadcast_to(np.asarray(low, dtype=np.float32), shape)
+        high = np.broadcast_to(np.asarray(high, dtype=np.float32), shape)
+        self._scale = np.maximum(high - low, 1e-6) / (self._qmax - self._qmin)
+        self._offset = low - self._qmin * self._scale
+
+    def encode(self, values):
+        q = np.rint((np.asarray(values, dtype=np.float32) - self._offset) / self._scale)
+        return np.clip(q, self._qmin, self._qmax).astype(self.dtype)
+
+    def decode(self, values, out=None):
+        if out is None:
+            return values.astype(np.float32) * self._scale + self._offset
+        np.multiply(values, self._scale, out=out)
+        out += self._offset
+        return out
+
+
+def range_from_stats(path, shape, num_stds=4.):
+    """ Per-feature range mean +- num_stds * std from the file with 'means'
+        and 'stds' arrays, features which are not present in the file are
+        assumed to be standardized. Only for environments which return raw
+        observations: observations which the environment already standardizes
+        with these stats (e.g. prosthetics_round2 with prosthetics_norm_v21.npz)
+        are in the range +- num_stds.
+    """
+    with np.load(path) as data:
+        means, stds = data['means'], data['stds']
+    size = int(np.prod(shape))
+    low = -num_stds * np.ones(size, dtype=np.float32)
+    high = num_stds * np.ones(size, dtype=np.float32)
+    n = min(size, len(means))
+    low[:n] = means[:n] - num_stds * stds[:n]
+    high[:n] = means[:n] + num_stds * stds[:n]
+    return low.reshape(shape), high.reshape(shape)
+
+
+def create_codec(params, shape):
+    """ Create codec from config parameters
+
+        dtype: float32 | float16 | int8 | uint8
+        low, high: range of quantized values (int8 and uint8 only)
+        num_stds: range +- num_stds of standardized values
+        stats: path to the file with means and stds of raw (not standardized)
+            values, the range is means +- num_stds * stds
+    """
+    if params is None:
+        return Float32Codec()
+    dtype = params.get('dtype', 'float32')
+    if dtype == 'float32':
+        return Float32Codec()
+    if dtype == 'float16':
+        return Float16Codec()
+    if dtype in ('int8', 'uint8'):
+        if 'stats' in params:
+            low, high = range_from_stats(
+                params['stats'], shape, params.get('num_stds', 4.))
+        elif 'num_stds' in params:
+            low, high = -params['num_stds'], params['num_stds']
+        else:
+            low, high = params.get('low', -1.), params.get('high', 1.)
+        return LinearQuantizationCodec(shape, dtype, low, high)
+    raise NotImplementedError(dtype)
+
+
+def create_storage_codecs(exp_config, observation_shapes, action_size):
+    """ Codecs for observation parts and actions
+        from server.observation_storage and server.action_storage,
+        parts with native dtype other than float32 (env.observation_parts)
+        are stored as is
+    """
+    server_config = exp_config.as_obj()['server']
+    obs_params = server_config.get('observation_storage')
+    observation_codecs = []
+    for shape, dtype in zip(observation_shapes, exp_config.get_observation_dtypes()):
+        if dtype == 'float32':
+            observation_codecs.append(create_codec(obs_params, shape))
+        else:
+            observation_codecs.append(RawCodec(dtype))
+    action_codec = create_codec(server_config.get('action_storage'), (action_size, ))
+    return observation_codecs, action_codec
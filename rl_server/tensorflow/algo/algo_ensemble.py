@@ -1,10 +1,13 @@
 import tensorflow as tf
 
+from .base_algo import batch_feed_dict
+
 
 class AlgoEnsemble:
     
     def __init__(self, algorithms, placeholders):
         self._algos = algorithms
+        self.placeholders = placeholders
         
         self.actor_lr_ph = placeholders[0]
         self.critic_lr_ph = placeholders[1]
@@ -13,6 +16,7 @@ class AlgoEnsemble:
         self.rewards_ph = placeholders[4]
         self.next_states_ph = placeholders[5]
         self.dones_ph = placeholders[6]
+        self.batch_source = placeholders[8]
 
         self.actor_loss_op = [algo.get_policy_loss_op() for algo in self._algos]
         self.critic_loss_op = [algo.get_value_loss_op() for algo in self._algos]
@@ -54,11 +58,7 @@ class AlgoEnsemble:
         feed_dict = {
             self.actor_lr_ph: actor_lr,
             self.critic_lr_ph: critic_lr,
-            **dict(zip(self.states_ph, batch.s)),
-            **{self.actions_ph: batch.a},
-            **{self.rewards_ph: batch.r},
-            **dict(zip(self.next_states_ph, batch.s_)),
-            **{self.dones_ph: batch.done}}
+            **batch_feed_dict(self.placeholders, batch)}
         ops_ = sess.run(self.train_op, feed_dict=feed_dict)
         losses_values = ops_[:len(self._algos) * 2]
         return [actor_lr, critic_lr] + losses_values
@@ -53,7 +53,12 @@ def create_algorithm(
 
     _, state_shapes, action_size = algo_config.get_env_shapes()
     if placeholders is None:
-        placeholders = create_placeholders(state_shapes, action_size)
+        # batches are fed, the staging queue and the graph replay buffer
+        # are built by the server (see run_server.py)
+        window_n_step = None
+        if getattr(algo_config.server, 'overlapping_state_windows', False):
+            window_n_step = algo_config.algorithm.n_step
+        placeholders = create_placeholders(state_shapes, action_size, window_n_step)
     
     actor_lr = placeholders[0]
     critic_lr = placeholders[1]
@@ -1,72 +1,183 @@
 import tensorflow as tf
 
+from rl_server.server.server_replay_buffer import WindowTransition
 
-def create_placeholders(state_shapes, action_size, scope="placeholders"):
+
+class BatchStagingQueue:
+
+    def __init__(self, capacity, dtypes, shapes, scope="batch_staging"):
+        """ In-graph FIFO queue of batches, a background thread enqueues
+            sampled batches while the train step dequeues the previous one,
+            so the copy of the next batch overlaps the compute of the current.
+            Tensors are listed as in the feeds of the batch: states
+            (or state windows) per part, next states per part (without
+            windows), actions, rewards, dones.
+        """
+        with tf.name_scope(scope):
+            self._enqueue_phs = [
+                tf.placeholder(dtype, shape, "enqueue" + str(i) + "_ph")
+                for i, (dtype, shape) in enumerate(zip(dtypes, shapes))]
+            self._queue = tf.FIFOQueue(capacity, dtypes)
+            self._enqueue_op = self._queue.enqueue(self._enqueue_phs)
+            self._close_op = self._queue.close(cancel_pending_enqueues=True)
+            self._dequeued = self._queue.dequeue()
+            for tensor, shape in zip(self._dequeued, shapes):
+                tensor.set_shape(shape)
+
+    def dequeued(self):
+        """ tensors of the batch taken from the queue, sess.run of anything
+            which depends on them and is not fed dequeues the next batch
+        """
+        return list(self._dequeued)
+
+    def enqueue(self, sess, batch):
+        """ put the batch sampled from the server buffer to the queue,
+            blocks while the queue is full
+        """
+        if isinstance(batch, WindowTransition):
+            arrays = list(batch.s_window)
+        else:
+            arrays = list(batch.s) + list(batch.s_)
+        arrays += [batch.a, batch.r, batch.done]
+        sess.run(self._enqueue_op, feed_dict=dict(zip(self._enqueue_phs, arrays)))
+
+    def close(self, sess):
+        sess.run(self._close_op)
+
+
+def create_placeholders(state_shapes, action_size, window_n_step=None,
+                        staging_capacity=None, graph_replay_buffer=None,
+                        scope="placeholders"):
+    """ if window_n_step is given, states and next states are fed as one
+        window of history_len + n_step observations (see WindowTransition)
+        and sliced in graph, states and next states are still feedable
+        separately (e.g. by act_batch)
+
+        if staging_capacity is given, batch tensors default to the batch
+        dequeued from BatchStagingQueue of this capacity, if
+        graph_replay_buffer is given, they default to the batch sampled
+        from it in graph, the queue or the buffer is the last element
+        (batch source), batch tensors can still be fed, e.g. with states
+        by act_batch
+    """
     with tf.name_scope(scope):
+        if window_n_step is not None:
+            batch_shapes = [
+                [None, shape[0] + window_n_step] + list(shape[1:]) for shape in state_shapes]
+            batch_names = ["state_windows" + str(i) for i in range(len(state_shapes))]
+        else:
+            batch_shapes = [[None] + list(shape) for shape in state_shapes] * 2
+            batch_names = ["states" + str(i) for i in range(len(state_shapes))]
+            batch_names += ["next_states" + str(i) for i in range(len(state_shapes))]
+        batch_shapes += [[None, action_size], [None, ], [None, ]]
+        batch_names += ["actions", "rewards", "dones"]
+
+        batch_source, batch_tensors = None, None
+        if graph_replay_buffer is not None:
+            if window_n_step is not None:
+                raise NotImplementedError(
+                    "graph replay buffer samples states and next states separately")
+            batch_source = graph_replay_buffer
+            batch_tensors = graph_replay_buffer.sample_batch()
+        elif staging_capacity is not None:
+            batch_source = BatchStagingQueue(
+                staging_capacity, [tf.float32] * len(batch_shapes), batch_shapes)
+            batch_tensors = batch_source.dequeued()
+        if batch_tensors is not None:
+            batch_ph = [
+                tf.placeholder_with_default(tensor, shape, name + "_ph")
+                for tensor, shape, name in zip(batch_tensors, batch_shapes, batch_names)]
+        else:
+            batch_ph = [
+                tf.placeholder(tf.float32, shape, name + "_ph")
+                for shape, name in zip(batch_shapes, batch_names)]
+
+        num_parts = len(state_shapes)
+        actions_ph, rewards_ph, dones_ph = batch_ph[-3:]
         states_ph, next_states_ph = [], []
-        for i, shape in enumerate(state_shapes):
-            states_batch_shape = [None] + list(shape)
-            states_ph.append(tf.placeholder(
-                tf.float32, states_batch_shape, "states" + str(i) + "_ph"))
-            next_states_ph.append(tf.placeholder(
-                tf.float32, states_batch_shape, "next_states" + str(i) + "_ph"))
-        actions_ph = tf.placeholder(
-            tf.float32, [None, action_size], "actions_ph")
-        rewards_ph = tf.placeholder(
-            tf.float32, [None, ], "rewards_ph")
-        dones_ph = tf.placeholder(
-            tf.float32, [None, ], "dones_ph")
+        state_windows_ph = None
+        if window_n_step is not None:
+            state_windows_ph = batch_ph[:num_parts]
+            for i, (shape, window_ph) in enumerate(zip(state_shapes, state_windows_ph)):
+                history_len = shape[0]
+                states_ph.append(tf.identity(
+                    window_ph[:, :history_len], "states" + str(i)))
+                next_states_ph.append(tf.identity(
+                    window_ph[:, window_n_step:], "next_states" + str(i)))
+        else:
+            states_ph = batch_ph[:num_parts]
+            next_states_ph = batch_ph[num_parts:2 * num_parts]
 
         actor_lr = tf.placeholder(tf.float32, (), "actor_lr")
         critic_lr = tf.placeholder(tf.float32, (), "critic_lr")
 
-    return (actor_lr, critic_lr, states_ph, actions_ph, rewards_ph, next_states_ph, dones_ph)
+    return (actor_lr, critic_lr, states_ph, actions_ph, rewards_ph, next_states_ph, dones_ph,
+            state_windows_ph, batch_source)
 
 
-# def create_placeholders_n_algos_with_split(state_shapes, action_size, num_algos, batch_size, scope="placeholders"):
-#     # construct one big batch for optimal loading
-#     big_batch_size = num_algos * batch_size
-#     with tf.name_scope(scope):
-#         states_ph, next_states_ph = [], []
-#         for i, shape in enumerate(state_shapes):
-#             states_batch_shape = [big_batch_size] + list(shape)
-#             states_ph.append(tf.placeholder(
-#                 tf.float32, states_batch_shape, "states"+str(i)+"_ph"))
-#             next_states_ph.append(tf.placeholder(
-#                 tf.float32, states_batch_shape, "next_states"+str(i)+"_ph"))
-#         actions_ph = tf.placeholder(
-#             tf.float32, [big_batch_size, action_size], "actions_ph")
-#         rewards_ph = tf.placeholder(
-#             tf.float32, [big_batch_size, ], "rewards_ph")
-#         dones_ph = tf.placeholder(
-#             tf.float32, [big_batch_size, ], "dones_ph")
-#
-#         # split big batch into individual batches
-#         splited_states_ph = [tf.split(st_ph, num_algos, axis=0) for st_ph in states_ph]
-#         splited_next_states_ph = [tf.split(st_ph, num_algos, axis=0) for st_ph in next_states_ph]
-#         splited_actions_ph = tf.split(actions_ph, num_algos, axis=0)
-#         splited_rewards_ph = tf.split(rewards_ph, num_algos, axis=0)
-#         splited_dones_ph = tf.split(dones_ph, num_algos, axis=0)
-#         splited_batches = list(zip(
-#             *(
-#                 splited_states_ph +
-#                 splited_next_states_ph +
-#                 [splited_actions_ph, splited_rewards_ph, splited_dones_ph]
-#             )
-#         ))
-#         # group observations
-#         num_obs = len(state_shapes)
-#         for i, splited_batch in enumerate(splited_batches):
-#             splited_batches[i] = [
-#                 splited_batch[:num_obs],
-#                 splited_batch[-3],
-#                 splited_batch[-2],
-#                 splited_batch[num_obs:2 * num_obs],
-#                 splited_batch[-1]
-#             ]
-#
-#     # big batch, then splitted batches
-#     return (states_ph, actions_ph, rewards_ph, next_states_ph, dones_ph), splited_batches
+def batch_feed_dict(placeholders, batch):
+    """ feed dict of the batch sampled from the server buffer,
+        either Transition or WindowTransition, batch is None
+        if it is taken in graph from the batch source
+    """
+    if batch is None:
+        return {}
+    (_, _, states_ph, actions_ph, rewards_ph, next_states_ph, dones_ph,
+     state_windows_ph, _) = placeholders
+    if state_windows_ph is not None:
+        feed_dict = dict(zip(state_windows_ph, batch.s_window))
+    else:
+        feed_dict = {
+            **dict(zip(states_ph, batch.s)),
+            **dict(zip(next_states_ph, batch.s_))}
+    feed_dict[actions_ph] = batch.a
+    feed_dict[rewards_ph] = batch.r
+    feed_dict[dones_ph] = batch.done
+    return feed_dict
+
+
+def create_placeholders_n_algos_with_split(state_shapes, action_size, num_algos,
+                                           window_n_step=None, staging_capacity=None,
+                                           graph_replay_buffer=None, scope="placeholders"):
+    """ one big batch for optimal loading, which consists of equal
+        sub-batches of all algorithms (see PartitionedServerBuffer),
+        every algorithm gets its own slice of it without extra feeds
+    """
+    big_batch_ph = create_placeholders(
+        state_shapes, action_size, window_n_step, staging_capacity,
+        graph_replay_buffer, scope)
+    (actor_lr, critic_lr, states_ph, actions_ph, rewards_ph,
+     next_states_ph, dones_ph, state_windows_ph, _) = big_batch_ph
+
+    with tf.name_scope(scope):
+        # split big batch into individual batches
+        splited_states_ph = [tf.split(st_ph, num_algos, axis=0) for st_ph in states_ph]
+        splited_next_states_ph = [tf.split(st_ph, num_algos, axis=0) for st_ph in next_states_ph]
+        splited_actions_ph = tf.split(actions_ph, num_algos, axis=0)
+        splited_rewards_ph = tf.split(rewards_ph, num_algos, axis=0)
+        splited_dones_ph = tf.split(dones_ph, num_algos, axis=0)
+        splited_state_windows_ph = None
+        if state_windows_ph is not None:
+            splited_state_windows_ph = [
+                tf.split(window_ph, num_algos, axis=0) for window_ph in state_windows_ph]
+
+    splited_batches = []
+    for i in range(num_algos):
+        splited_batches.append((
+            actor_lr,
+            critic_lr,
+            [st_ph[i] for st_ph in splited_states_ph],
+            splited_actions_ph[i],
+            splited_rewards_ph[i],
+            [st_ph[i] for st_ph in splited_next_states_ph],
+            splited_dones_ph[i],
+            None if splited_state_windows_ph is None else
+            [window_ph[i] for window_ph in splited_state_windows_ph],
+            # batches are taken from the source of the big batch
+            None))
+
+    # big batch, then splitted batches
+    return big_batch_ph, splited_batches
 
 
 # def create_placeholders_n_algos_random_sample(state_shapes, action_size, num_algos, big_batch_size, algo_batch_size, scope="placeholders"):
@@ -196,6 +307,11 @@ class BaseAlgo:
         self.rewards_ph = self.placeholders[4]
         self.next_states_ph = self.placeholders[5]
         self.dones_ph = self.placeholders[6]
+        self.state_windows_ph = self.placeholders[7]
+        self.batch_source = self.placeholders[8]
+
+    def get_batch_feed_dict(self, batch):
+        return batch_feed_dict(self.placeholders, batch)
 
     def init(self, sess):
         sess.run(tf.global_variables_initializer())
@@ -51,11 +51,7 @@ class PrioritizedDDPG(DDPG):
         feed_dict = {
             self.actor_lr_ph: actor_lr,
             self.critic_lr_ph: critic_lr,
-            **dict(zip(self.states_ph, batch.s)),
-            **{self.actions_ph: batch.a},
-            **{self.rewards_ph: batch.r},
-            **dict(zip(self.next_states_ph, batch.s_)),
-            **{self.dones_ph: batch.done},
+            **self.get_batch_feed_dict(batch),
             self._is_weights: is_weights
         }
         ops = [self._q_values, self._value_loss, self._policy_loss]
@@ -74,13 +70,6 @@ class PrioritizedDDPG(DDPG):
 
     def get_td_errors(self, sess, batch):
 
-        feed_dict = {self.rewards_ph: batch.r,
-                     self.actions_ph: batch.a,
-                     self.dones_ph: batch.done}
-
-        for i in range(len(batch.s)):
-            feed_dict[self.states_ph[i]] = batch.s[i]
-            feed_dict[self.next_states_ph[i]] = batch.s_[i]
-
+        feed_dict = self.get_batch_feed_dict(batch)
         td_errors = sess.run(self._td_errors, feed_dict=feed_dict)
         return td_errors
@@ -222,11 +222,7 @@ class SAC(BaseAlgo):
         feed_dict = {
             self.actor_lr_ph: actor_lr,
             self.critic_lr_ph: critic_lr,
-            **dict(zip(self.states_ph, batch.s)),
-            **{self.actions_ph: batch.a},
-            **{self.rewards_ph: batch.r},
-            **dict(zip(self.next_states_ph, batch.s_)),
-            **{self.dones_ph: batch.done}}
+            **self.get_batch_feed_dict(batch)}
         ops = [self._q1_loss, self._v_loss, self._policy_loss]
         if critic_update:
             ops.append(self._critic_q1_update)
@@ -0,0 +1,203 @@
+from threading import Lock
+
+import numpy as np
+import tensorflow as tf
+
+
+class GraphReplayBuffer:
+
+    def __init__(self, capacity, observation_shapes, action_size,
+                 history_len=1, n_step=1, gamma=0.99, scope="graph_replay_buffer"):
+        """ Replay buffer stored in TF variables for environments with small
+            observations. Episodes are appended by assign ops and batches
+            are sampled in the training graph: history windows and n-step
+            returns are gathered the same way as in ServerBuffer, so the
+            train step is a single sess.run without batch feeds.
+
+            Variables are local (not saved with checkpoints). Appends are
+            serialized, a train step which samples a slot being overwritten
+            at the same time may read it half-written.
+
+        Parameters
+        ----------
+        capacity: int
+            maximal number of stored transitions
+        observation_shapes: list of tuples [obs_shape_1, ..., obs_shape_n]
+            which corresponds to observations" shapes
+        action_size: int
+            size of the action vector
+        history_len, n_step, gamma:
+            parameters of the sampled batches
+        """
+        self.size = capacity
+        self.obs_shapes = [tuple(shape) for shape in observation_shapes]
+        self.act_shape = (action_size, )
+        self.history_len = history_len
+        self.n_step = n_step
+        self.gamma = gamma
+        self.stored_in_buffer = 0
+        self._batch_size = None
+        self._sess = None
+        self._append_lock = Lock()
+
+        with tf.variable_scope(scope):
+
+            def variable(name, shape, dtype):
+                return tf.get_variable(
+                    name, (capacity, ) + tuple(shape), dtype,
+                    initializer=tf.zeros_initializer(), trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+            def counter(name):
+                return tf.get_variable(
+                    name, (), tf.int32, initializer=tf.zeros_initializer(),
+                    trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+            self._observations = [
+                variable("observations" + str(i), shape, tf.float32)
+                for i, shape in enumerate(self.obs_shapes)]
+            self._actions = variable("actions", self.act_shape, tf.float32)
+            self._rewards = variable("rewards", (), tf.float32)
+            self._dones = variable("dones", (), tf.float32)
+            # position of the transition within its episode (0 for the first one)
+            self._episode_offsets = variable("episode_offsets", (), tf.int32)
+            self._pointer = counter("pointer")
+            self._num_in_buffer = counter("num_in_buffer")
+            self._batch_size_var = counter("batch_size")
+
+            self._build_append()
+            self._new_batch_size_ph = tf.placeholder(tf.int32, (), "batch_size_ph")
+            self._set_batch_size_op = self._batch_size_var.assign(self._new_batch_size_ph)
+            self._init_op = tf.variables_initializer(
+                self._observations + [
+                    self._actions, self._rewards, self._dones, self._episode_offsets,
+                    self._pointer, self._num_in_buffer, self._batch_size_var])
+
+    def _build_append(self):
+        self._episode_phs = [
+            tf.placeholder(tf.float32, (None, ) + shape, "observations" + str(i) + "_ph")
+            for i, shape in enumerate(self.obs_shapes)]
+        self._episode_phs += [
+            tf.placeholder(tf.float32, (None, ) + self.act_shape, "actions_ph"),
+            tf.placeholder(tf.float32, (None, ), "rewards_ph"),
+            tf.placeholder(tf.float32, (None, ), "dones_ph")]
+        episode_len = tf.shape(self._episode_phs[-1])[0]
+        indices = (self._pointer + tf.range(episode_len)) % self.size
+        variables = self._observations + [self._actions, self._rewards, self._dones]
+        writes = [
+            tf.scatter_update(var, indices, values, use_locking=True)
+            for var, values in zip(variables, self._episode_phs)]
+        writes.append(tf.scatter_update(
+            self._episode_offsets, indices, tf.range(episode_len), use_locking=True))
+        # counters are published after the data
+        with tf.control_dependencies(writes):
+            self._append_op = tf.group(
+                self._pointer.assign((self._pointer + episode_len) % self.size),
+                self._num_in_buffer.assign(tf.minimum(self._num_in_buffer + episode_len, self.size)))
+
+    def _get_ages(self, indices):
+        """ number of transitions stored before the given ones
+        """
+        full = tf.equal(self._num_in_buffer, self.size)
+        return tf.where(
+            tf.fill(tf.shape(indices), full), (indices - self._pointer) % self.size, indices)
+
+    def _get_states(self, indices):
+        """ windows of history_len observations ending at indices,
+            observations of the previous episodes are zero-padded
+        """
+        steps = tf.range(-self.history_len + 1, 1)
+        window = (indices[:, None] + steps[None, :]) % self.size
+        limit = tf.minimum(tf.gather(self._episode_offsets, indices), self._get_ages(indices))
+        mask = tf.cast(steps[None, :] >= -limit[:, None], tf.float32)
+        states = []
+        for obs, shape in zip(self._observations, self.obs_shapes):
+            s = tf.gather(obs, window)
+            states.append(s * tf.reshape(mask, [-1, self.history_len] + [1] * len(shape)))
+        return states
+
+    def sample_batch(self):
+        """ tensors of a uniformly sampled batch in the order of the batch
+            placeholders: states per part, next states per part, actions,
+            rewards (n-step returns), dones
+        """
+        indices = tf.random_uniform(
+            tf.expand_dims(self._batch_size_var, 0),
+            0, tf.maximum(self._num_in_buffer, 1), tf.int32)
+
+        forward = tf.range(self.n_step)
+        steps = (indices[:, None] + forward[None, :]) % self.size
+        offsets = tf.gather(self._episode_offsets, indices)
+        # step belongs to the same episode and does not cross the newest transition
+        valid = tf.equal(tf.gather(self._episode_offsets, steps), offsets[:, None] + forward)
+        valid &= self._get_ages(indices)[:, None] + forward < self._num_in_buffer
+        dones = tf.gather(self._dones, steps)
+        # reward at step k is used only if there were no dones before it
+        used = tf.cast(valid, tf.float32) * tf.cast(
+            tf.equal(tf.cumsum(dones, axis=1, exclusive=True), 0), tf.float32)
+        discounts = tf.constant(
+            np.power(self.gamma, np.arange(self.n_step)), dtype=tf.float32)
+        returns = tf.reduce_sum(tf.gather(self._rewards, steps) * discounts * used, axis=1)
+        next_indices = (indices + tf.cast(tf.reduce_sum(used, axis=1), tf.int32)) % self.size
+        episode_dones = tf.reduce_max(dones * used, axis=1)
+
+        return (
+            self._get_states(indices) + self._get_states(next_indices)
+            + [tf.gather(self._actions, indices), returns, episode_dones])
+
+    def set_session(self, sess):
+        """ session used by push_episode, variables are initialized in it
+        """
+        self._sess = sess
+        sess.run(self._init_op)
+
+    def set_batch_size(self, batch_size):
+        if batch_size != self._batch_size:
+            self._sess.run(
+                self._set_batch_size_op, feed_dict={self._new_batch_size_ph: batch_size})
+            self._batch_size = batch_size
+
+    def push_episode(self, episode):
+        """ episode = [observations, actions, rewards, dones]
+            observations = [obs_part_1, ..., obs_part_n]
+        """
+        observations, actions, rewards, dones = episode[:4]
+        values = list(observations) + [actions, rewards, np.asarray(dones, dtype=np.float32)]
+        with self._append_lock:
+            self._sess.run(self._append_op, feed_dict=dict(zip(self._episode_phs, values)))
+            self.stored_in_buffer += len(rewards)
+
+    def get_stored_in_buffer(self):
+        return self.stored_in_buffer
+
+    def register_n_step(self, n_step=1, gamma=0.99):
+        assert (n_step, gamma) == (self.n_step, self.gamma), \
+            "n-step returns of the graph replay buffer are built for n_step {}, gamma {}".format(
+                self.n_step, self.gamma)
+
+    def get_memory_usage(self):
+        """ bytes taken by every variable of the buffer
+        """
+        usage = {
+            "observations" + str(i): self.size * int(np.prod(shape)) * 4
+            for i, shape in enumerate(self.obs_shapes)}
+        usage["actions"] = self.size * self.act_shape[0] * 4
+        for name in ("rewards", "dones", "episode_offsets"):
+            usage[name] = self.size * 4
+        return usage
+
+
+def create_graph_replay_buffer(exp_config):
+    """ GraphReplayBuffer of server.experience_replay_buffer_size transitions
+        if server.graph_replay_buffer is set, None otherwise
+    """
+    if not getattr(exp_config.server, 'graph_replay_buffer', False):
+        return None
+    observation_shapes, _, action_size = exp_config.get_env_shapes()
+    return GraphReplayBuffer(
+        exp_config.server.experience_replay_buffer_size,
+        observation_shapes,
+        action_size,
+        history_len=exp_config.env.history_length,
+        n_step=exp_config.algorithm.n_step,
+        gamma=exp_config.algorithm.gamma)
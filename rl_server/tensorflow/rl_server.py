@@ -1,22 +1,62 @@
 from rl_server.server.rl_server_api import RLServerAPI
+from rl_server.server.storage_codecs import create_storage_codecs
 from rl_server.server.rl_trainer_tf import TFRLTrainer as RLTrainer
+from rl_server.tensorflow.graph_replay_buffer import GraphReplayBuffer
 
 
 class RLServer:
 
     def __init__(self, exp_config, agent_algorithm):
         observation_shapes, state_shapes, action_size = exp_config.get_env_shapes()
-        self._server_api = RLServerAPI(
-            exp_config.server.num_clients,
-            observation_shapes,
-            state_shapes,
-            init_port=exp_config.server.client_start_port)
+        observation_codecs, action_codec = create_storage_codecs(
+            exp_config, observation_shapes, action_size)
+        num_partitions = 1
+        if exp_config.is_ensemble() and getattr(exp_config.server, 'partitioned_buffer', False):
+            num_partitions = len(exp_config.ensemble.algorithms)
+        # transitions are stored in the graph of the algorithm
+        graph_replay_buffer = getattr(agent_algorithm, 'batch_source', None)
+        if not isinstance(graph_replay_buffer, GraphReplayBuffer):
+            graph_replay_buffer = None
+        if getattr(exp_config.server, 'single_port', False):
+            # asyncio.run needs python 3.7
+            from rl_server.server.async_rl_server_api import AsyncRLServerAPI
+            self._server_api = AsyncRLServerAPI(
+                exp_config.server.num_clients,
+                observation_shapes,
+                state_shapes,
+                init_port=exp_config.server.client_start_port,
+                num_workers=getattr(exp_config.server, 'api_workers', 4))
+        else:
+            self._server_api = RLServerAPI(
+                exp_config.server.num_clients,
+                observation_shapes,
+                state_shapes,
+                init_port=exp_config.server.client_start_port)
 
         self._train_loop = RLTrainer(
             observation_shapes=observation_shapes,
             action_size=action_size,
             experience_replay_buffer_size=exp_config.server.experience_replay_buffer_size,
+            experience_replay_buffer_path=getattr(
+                exp_config.server, 'experience_replay_buffer_path', None),
+            buffer_memory_gb=getattr(exp_config.server, 'buffer_memory_gb', None),
+            prefault_buffer=getattr(exp_config.server, 'prefault_buffer', False),
+            lock_free_buffer=getattr(exp_config.server, 'lock_free_buffer', False),
+            state_windows=getattr(exp_config.server, 'overlapping_state_windows', False),
+            batches_per_sample=getattr(exp_config.server, 'batches_per_sample', 1),
+            observation_codecs=observation_codecs,
+            action_codec=action_codec,
             use_prioritized_buffer=exp_config.server.use_prioritized_buffer,
+            priority=getattr(exp_config.server, 'priority', 'proportional'),
+            rank_sort_period=getattr(exp_config.server, 'rank_sort_period', 1000),
+            num_partitions=num_partitions,
+            partition_mixing=getattr(exp_config.server, 'partition_mixing', None),
+            recurrent_state_size=getattr(exp_config.server, 'recurrent_state_size', None),
+            cold_storage=exp_config.as_obj()['server'].get('cold_storage'),
+            ingest_filters=exp_config.as_obj()['server'].get('ingest_filters'),
+            batch_prefetch_workers=getattr(exp_config.server, 'batch_prefetch_workers', 0),
+            batch_prefetch_slots=getattr(exp_config.server, 'batch_prefetch_slots', None),
+            server_buffer=graph_replay_buffer,
             n_step=exp_config.algorithm.n_step,
             gamma=exp_config.algorithm.gamma,
             train_every_nth=exp_config.server.train_every_nth,
@@ -26,6 +66,8 @@ class RLServer:
             target_actor_update_period=exp_config.server.target_actor_update_period,
             show_stats_period=exp_config.server.show_stats_period,
             save_model_period=exp_config.server.save_model_period,
+            save_replay_buffer=getattr(exp_config.server, 'save_replay_buffer', False),
+            compress_replay_buffer=getattr(exp_config.server, 'compress_replay_buffer', False),
             logdir=exp_config.server.logdir)
 
         self._train_loop.set_algorithm(agent_algorithm)
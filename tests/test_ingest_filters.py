@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from rl_server.server import ingest_filters
+from rl_server.server.ingest_filters import (
+    merge_transitions, StrideFilter, NearDuplicateFilter, AgentRateFilter,
+    create_ingest_filters)
+
+
+def make_episode(observations, done=True):
+    observations = np.asarray(observations, dtype=np.float32).reshape(-1, 1)
+    length = len(observations)
+    dones = np.zeros(length, dtype=bool)
+    dones[-1:] = done
+    return [
+        [observations, np.tile(observations, (1, 2))],
+        np.arange(length, dtype=np.float32).reshape(-1, 1),
+        np.arange(1, length + 1, dtype=np.float32),
+        dones]
+
+
+def test_merge_keeps_return_and_done():
+    episode = make_episode(np.arange(6))
+    merged = merge_transitions(episode, [False, False, True, False, False, False])
+    observations, actions, rewards, dones = merged
+    # the first transition is always kept
+    np.testing.assert_array_equal(observations[0].ravel(), [0, 2])
+    np.testing.assert_array_equal(observations[1][:, 0], [0, 2])
+    np.testing.assert_array_equal(actions.ravel(), [0, 2])
+    np.testing.assert_array_equal(rewards, [1 + 2, 3 + 4 + 5 + 6])
+    np.testing.assert_array_equal(dones, [False, True])
+    assert rewards.sum() == episode[2].sum()
+
+
+def test_merge_without_drops_returns_episode():
+    episode = make_episode(np.arange(4))
+    assert merge_transitions(episode, np.ones(4, dtype=bool)) is episode
+
+
+def test_stride_filter():
+    episode = make_episode(np.arange(7))
+    observations, _, rewards, dones = StrideFilter(3)(episode, 0)
+    np.testing.assert_array_equal(observations[0].ravel(), [0, 3, 6])
+    np.testing.assert_array_equal(rewards, [1 + 2 + 3, 4 + 5 + 6, 7])
+    np.testing.assert_array_equal(dones, [False, False, True])
+
+
+def test_near_duplicate_filter():
+    episode = make_episode([0., 0., 1e-4, 1., 1., 2.])
+    observations, _, rewards, dones = NearDuplicateFilter(1e-3)(episode, 0)
+    np.testing.assert_array_equal(observations[0].ravel(), [0., 1., 2.])
+    np.testing.assert_array_equal(rewards, [1 + 2 + 3, 4 + 5, 6])
+    assert dones[-1]
+
+
+def test_near_duplicate_filter_does_not_merge_drift():
+    # every step is below the threshold, the change from the last kept one is not
+    episode = make_episode(np.arange(10) * 4e-4)
+    observations, _, _, _ = NearDuplicateFilter(1e-3)(episode, 0)
+    np.testing.assert_allclose(observations[0].ravel(), np.array([0, 3, 6, 9]) * 4e-4)
+
+
+@pytest.mark.parametrize("length", [0, 1])
+def test_near_duplicate_filter_short_episode(length):
+    episode = make_episode(np.arange(length))
+    assert NearDuplicateFilter()(episode, 0) is episode
+
+
+def test_rate_filter_drops_and_refills(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(ingest_filters.time, "time", lambda: now[0])
+    rate_filter = AgentRateFilter(max_rate=10., burst=2.)
+    episode = make_episode(np.arange(15))
+
+    assert rate_filter(episode, 0) is episode
+    # 5 tokens left, other agents have their own buckets
+    assert rate_filter(episode, 0) is None
+    assert rate_filter(episode, 1) is episode
+    now[0] += 1.
+    assert rate_filter(episode, 0) is episode
+    # episodes longer than the bucket are accepted when it is full
+    now[0] += 10.
+    assert rate_filter(make_episode(np.arange(50)), 0) is not None
+
+
+def test_pipeline_stats():
+    pipeline = create_ingest_filters([
+        {'type': 'stride', 'stride': 2},
+        {'type': 'rate_cap', 'max_rate': 1., 'burst': 4.}])
+    assert pipeline(make_episode(np.arange(8)), agent_id=0) is not None
+    assert pipeline(make_episode(np.arange(8)), agent_id=0) is None
+    stats = pipeline.get_stats()
+    assert stats['received'] == 16
+    assert stats['stored'] == 4
+    assert stats['dropped_episodes'] == 1
+    assert stats['dropped_0_StrideFilter'] == 8
+    assert stats['dropped_1_AgentRateFilter'] == 4
+
+
+def test_pipeline_stats_of_filters_of_one_type():
+    pipeline = create_ingest_filters([
+        {'type': 'stride', 'stride': 2},
+        {'type': 'stride', 'stride': 4}])
+    pipeline(make_episode(np.arange(8)), agent_id=0)
+    stats = pipeline.get_stats()
+    assert stats['dropped_0_StrideFilter'] == 4
+    assert stats['dropped_1_StrideFilter'] == 3
+
+
+def test_no_filters():
+    assert create_ingest_filters(None) is None
+    with pytest.raises(NotImplementedError):
+        create_ingest_filters([{'type': 'unknown'}])
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from rl_server.server.segment_tree import SumTree, MinTree
+
+
+@pytest.mark.parametrize("capacity", [1, 5, 64, 100])
+def test_trees_match_numpy_after_updates(capacity):
+    rng = np.random.RandomState(0)
+    sum_tree, min_tree = SumTree(capacity), MinTree(capacity)
+    values = np.zeros(capacity)
+    for _ in range(20):
+        indices = rng.choice(capacity, size=rng.randint(1, capacity + 1), replace=False)
+        new_values = rng.uniform(0.1, 10., size=len(indices))
+        sum_tree[indices] = new_values
+        min_tree[indices] = new_values
+        values[indices] = new_values
+        written = values > 0
+        assert sum_tree.sum() == pytest.approx(values.sum())
+        assert min_tree.min() == pytest.approx(values[written].min())
+        np.testing.assert_array_equal(sum_tree[np.arange(capacity)], values)
+
+
+def test_empty_update_keeps_tree():
+    tree = SumTree(8)
+    tree[np.arange(8)] = np.ones(8)
+    tree[np.array([], dtype=np.int64)] = np.array([])
+    assert tree.sum() == 8.
+
+
+def test_find_prefixsum_idx_matches_cumsum():
+    rng = np.random.RandomState(1)
+    capacity = 37
+    values = rng.uniform(0., 5., size=capacity)
+    values[[3, 4, 20]] = 0.
+    tree = SumTree(capacity)
+    tree[np.arange(capacity)] = values
+
+    prefixsums = rng.uniform(0., values.sum(), size=1000)
+    expected = np.searchsorted(np.cumsum(values), prefixsums, side="right")
+    np.testing.assert_array_equal(tree.find_prefixsum_idx(prefixsums), expected)
+    # zero priorities are never sampled
+    assert not np.isin(tree.find_prefixsum_idx(prefixsums), [3, 4, 20]).any()
+
+
+def test_find_prefixsum_idx_follows_priorities():
+    tree = SumTree(4)
+    tree[np.arange(4)] = np.array([1., 0., 3., 0.])
+    prefixsums = (np.arange(4000) + 0.5) / 1000.
+    counts = np.bincount(tree.find_prefixsum_idx(prefixsums), minlength=4)
+    np.testing.assert_array_equal(counts, [1000, 0, 3000, 0])
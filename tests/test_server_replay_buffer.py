@@ -0,0 +1,439 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from rl_server.server.server_replay_buffer import ServerBuffer, WindowTransition
+from rl_server.server.storage_codecs import Float32Codec, RawCodec
+from rl_server.server.cold_replay_storage import ColdStorage
+
+
+OBS_SHAPES = [(3, ), (3, )]
+ACTION_SIZE = 2
+
+
+def make_episode(length, start=0, done=True):
+    """ observations and actions encode the global step number,
+        so every gathered value tells where it was read from
+    """
+    steps = np.arange(start, start + length, dtype=np.float32)
+    observations = [
+        np.tile(steps.reshape(-1, 1), (1, 3)),
+        np.tile(steps.reshape(-1, 1), (1, 3)) + 0.5]
+    actions = np.stack([steps, -steps], axis=1)
+    rewards = np.sin(steps).astype(np.float32)
+    dones = np.zeros(length, dtype=bool)
+    dones[-1] = done
+    return [observations, actions, rewards, dones]
+
+
+def fill(buffer, lengths, done=True):
+    start = 0
+    for length in lengths:
+        buffer.push_episode(make_episode(length, start, done))
+        start += length
+
+
+def loop_state(buffer, idx, history_len):
+    """ state composed by the per-transition loop of the original buffer,
+        history stops at the previous done or at the unwritten slots
+    """
+    state = []
+    for part_id in range(buffer.num_parts):
+        s = np.zeros((history_len, ) + buffer.obs_shapes[part_id], dtype=np.float32)
+        indices = [idx]
+        for i in range(history_len - 1):
+            prev_idx = (idx - i - 1) % buffer.size
+            if prev_idx >= buffer.num_in_buffer or buffer.dones[prev_idx]:
+                break
+            indices.append(prev_idx)
+        indices = indices[::-1]
+        s[-len(indices):] = buffer.observations[part_id][indices]
+        state.append(s)
+    return state
+
+
+def loop_transition(buffer, idx, history_len, n_step, gamma):
+    """ n-step transition of the original buffer: rewards are summed up to
+        the first done, next state is taken n_step ahead
+    """
+    state = loop_state(buffer, idx, history_len)
+    next_state = loop_state(buffer, (idx + n_step) % buffer.size, history_len)
+    cum_reward = 0
+    for num, i in enumerate(np.arange(idx, idx + n_step) % buffer.size):
+        cum_reward += buffer.rewards[i] * (gamma ** num)
+        done = buffer.dones[i]
+        if done:
+            break
+    return state, buffer.actions[idx], cum_reward, next_state, done
+
+
+def assert_precomputed_returns_match(done):
+    """ returns computed at insert time equal the ones computed over
+        the ring when the (n_step, gamma) is registered later
+    """
+    early = ServerBuffer(50, OBS_SHAPES, ACTION_SIZE)
+    early.register_n_step(3, 0.9)
+    late = ServerBuffer(50, OBS_SHAPES, ACTION_SIZE)
+    for buffer in (early, late):
+        fill(buffer, [11, 2, 19, 7, 25], done)
+    late.register_n_step(3, 0.9)
+
+    indices = np.arange(early.num_in_buffer)
+    for array, ring_values in zip(
+            early.register_n_step(3, 0.9), late.get_n_step_returns(indices, 3, 0.9)):
+        np.testing.assert_allclose(array[indices], ring_values, atol=1e-5)
+
+
+# every episode ends with done, the only layout the original loop handled,
+# the last lengths overwrite the beginning of the ring
+@pytest.mark.parametrize("lengths", [[7, 1, 12, 5], [30, 9, 17, 21, 3, 40]])
+@pytest.mark.parametrize("history_len,n_step", [(1, 1), (3, 1), (1, 4), (4, 3)])
+def test_batch_matches_loop(lengths, history_len, n_step):
+    gamma = 0.9
+    buffer = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE)
+    fill(buffer, lengths)
+    indices = np.arange(buffer.num_in_buffer)
+    batch = buffer.get_batch(len(indices), history_len, n_step, gamma, indices)
+
+    for row, idx in enumerate(indices):
+        s, a, r, s_, done = loop_transition(buffer, idx, history_len, n_step, gamma)
+        for part_id in range(buffer.num_parts):
+            np.testing.assert_array_equal(batch.s[part_id][row], s[part_id])
+            # terminal transitions do not bootstrap, the loop takes
+            # the next state n_step ahead even after the done
+            if not done:
+                np.testing.assert_array_equal(batch.s_[part_id][row], s_[part_id])
+        np.testing.assert_array_equal(batch.a[row], a)
+        assert batch.r[row] == pytest.approx(r, abs=1e-5)
+        assert batch.done[row] == done
+
+
+@pytest.mark.parametrize("history_len,n_step", [(1, 1), (3, 2), (2, 5)])
+def test_window_batch_matches_loop(history_len, n_step):
+    gamma = 0.95
+    buffer = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE)
+    fill(buffer, [30, 9, 17, 21, 3, 40])
+    indices = np.arange(buffer.num_in_buffer)
+    batch = buffer.get_batch(len(indices), history_len, n_step, gamma, indices, window=True)
+    assert isinstance(batch, WindowTransition)
+
+    for row, idx in enumerate(indices):
+        s, a, r, s_, done = loop_transition(buffer, idx, history_len, n_step, gamma)
+        for part_id in range(buffer.num_parts):
+            window = batch.s_window[part_id][row]
+            np.testing.assert_array_equal(window[:history_len], s[part_id])
+            if not done:
+                np.testing.assert_array_equal(window[n_step:], s_[part_id])
+        np.testing.assert_array_equal(batch.a[row], a)
+        assert batch.r[row] == pytest.approx(r, abs=1e-5)
+        assert batch.done[row] == done
+
+
+def test_precomputed_returns_match_ring_returns():
+    assert_precomputed_returns_match(done=True)
+
+
+def test_precomputed_returns_of_truncated_episodes():
+    # episodes without done end at the episode boundary
+    assert_precomputed_returns_match(done=False)
+
+
+def test_storage_path_reattach(tmpdir):
+    path = str(tmpdir.join("buffer"))
+    buffer = ServerBuffer(50, OBS_SHAPES, ACTION_SIZE, storage_path=path, header_period=2)
+    fill(buffer, [5, 6, 7])
+    # the header is published every 2 pushes and by flush
+    assert ServerBuffer(50, OBS_SHAPES, ACTION_SIZE, storage_path=path).num_in_buffer == 11
+    buffer.flush()
+    reattached = ServerBuffer(50, OBS_SHAPES, ACTION_SIZE, storage_path=path)
+    assert reattached.num_in_buffer == reattached.pointer == 18
+    np.testing.assert_array_equal(reattached.actions[:18], buffer.actions[:18])
+
+    with pytest.raises(ValueError):
+        ServerBuffer(50, OBS_SHAPES, ACTION_SIZE, storage_path=path,
+                     observation_codecs=[RawCodec(np.uint8), Float32Codec()])
+
+
+def test_cold_transitions_match_stored_episodes(tmpdir):
+    """ first segment holds steps 0..15, it ends within the episode 10..19
+    """
+    cold_storage = ColdStorage(
+        str(tmpdir.join("cold")), fraction=1., segment_size=16, cache_segments=1)
+    buffer = ServerBuffer(32, OBS_SHAPES, ACTION_SIZE, cold_storage=cold_storage)
+    fill(buffer, [10, 10, 10, 10, 10])
+    cold_storage.close()
+    assert cold_storage.get_sample_size(200) == 0
+    cold_storage.close()
+    assert cold_storage.get_sample_size(200) == 200
+
+    batch = buffer._allocate_batch(200, 2, 3, False)[0]
+    cold_storage.sample(200, 2, 3, 0.9, False, batch)
+    steps = batch.s[0][:, -1, 0].astype(np.int64)
+    assert steps.max() < 16 - 3
+
+    reference = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE)
+    fill(reference, [10, 10, 10, 10, 10])
+    expected = reference.get_batch(200, 2, 3, 0.9, steps)
+    for part, expected_part in zip(batch.s_, expected.s_):
+        np.testing.assert_array_equal(part, expected_part)
+    for name in ("a", "r", "done"):
+        np.testing.assert_allclose(getattr(batch, name), getattr(expected, name), rtol=1e-6)
+
+
+@pytest.mark.parametrize("lock_free", [False, True])
+def test_sequence_batch_is_masked_at_episode_end(lock_free):
+    buffer = ServerBuffer(50, OBS_SHAPES, ACTION_SIZE, lock_free=lock_free, segment_size=16)
+    fill(buffer, [12, 9, 20])
+    returns = buffer.register_n_step(2, 0.9)
+    # burn-in of 2 and 4 trained steps from the slots 6 (episode ends at 11)
+    # and 14 (ends at 20, slot 21 is the next episode)
+    indices = np.array([6, 14])
+    batch = buffer.get_sequence_batch(2, 4, burn_in=2, n_step=2, gamma=0.9, indices=indices)
+    assert batch.initial_state is None
+    np.testing.assert_array_equal(batch.mask, [[True] * 6, [True] * 6])
+    np.testing.assert_array_equal(batch.s[0][0, :, 0], [6, 7, 8, 9, 10, 11, 0, 0])
+    np.testing.assert_array_equal(batch.s[1][1, :, 0], list(np.arange(14, 21) + 0.5) + [0])
+    np.testing.assert_allclose(batch.r[0], returns.returns[6:12])
+    np.testing.assert_array_equal(batch.offsets[0], [2, 2, 2, 2, 2, 1])
+    np.testing.assert_array_equal(batch.done[0], [False] * 4 + [True] * 2)
+
+    batch = buffer.get_sequence_batch(1, 4, burn_in=2, n_step=2, gamma=0.9, indices=[9])
+    np.testing.assert_array_equal(batch.mask[0], [True, True, True, False, False, False])
+    np.testing.assert_array_equal(batch.a[0, 3:], np.zeros((3, ACTION_SIZE)))
+    np.testing.assert_array_equal(batch.r[0, 3:], [0, 0, 0])
+
+
+def test_sequence_batch_initial_recurrent_states():
+    buffer = ServerBuffer(20, OBS_SHAPES, ACTION_SIZE, recurrent_state_size=4)
+    episode = make_episode(10)
+    buffer.push_episode(episode + [np.arange(40, dtype=np.float32).reshape(10, 4)])
+    # episodes without states store zero states
+    buffer.push_episode(make_episode(5, 10))
+    batch = buffer.get_sequence_batch(2, 3, indices=[2, 11])
+    np.testing.assert_array_equal(batch.initial_state, [[8, 9, 10, 11], [0, 0, 0, 0]])
+
+
+def test_parts_of_different_shapes_and_dtypes():
+    """ uint8 image part is stored as is and decoded to float32 in batches
+    """
+    image = np.arange(5 * 4 * 4, dtype=np.uint8).reshape(5, 4, 4)
+    vector = np.arange(5 * 3, dtype=np.float32).reshape(5, 3)
+    buffer = ServerBuffer(
+        10, [(3, ), (4, 4)], ACTION_SIZE,
+        observation_codecs=[Float32Codec(), RawCodec(np.uint8)])
+    assert buffer.observations[1].dtype == np.uint8
+    buffer.push_episode([
+        [vector, image], np.zeros((5, ACTION_SIZE), dtype=np.float32),
+        np.ones(5, dtype=np.float32), np.arange(5) == 4])
+
+    indices = np.arange(4)
+    batch = buffer.get_batch(4, 2, 1, 0.9, indices)
+    assert batch.s[1].dtype == np.float32
+    np.testing.assert_array_equal(batch.s[0][:, -1], vector[indices])
+    np.testing.assert_array_equal(batch.s[1][:, -1], image[indices])
+    np.testing.assert_array_equal(batch.s_[1][:, -1], image[indices + 1])
+    np.testing.assert_array_equal(batch.s[1][0, 0], np.zeros((4, 4)))
+
+
+def test_lock_free_rereads_torn_transitions():
+    """ transitions whose segments were written while the batch was
+        gathered are read again and match a batch read after the write
+    """
+    buffer = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE, lock_free=True, segment_size=16)
+    fill(buffer, [20, 20, 24])
+    indices = np.arange(0, 64, 3)
+    gather = buffer._gather_batch
+    calls = []
+
+    def gather_during_push(*args, **kwargs):
+        batch = gather(*args, **kwargs)
+        if not calls:
+            # episode overwrites slots 0..9 between the seq reads
+            buffer.push_episode(make_episode(10, 1000))
+        calls.append(len(args[4]))
+        return batch
+
+    buffer._gather_batch = gather_during_push
+    batch = buffer.get_batch(len(indices), 3, 2, 0.9, indices)
+    buffer._gather_batch = gather
+
+    # rows of the first segment and the ones whose history reaches into it
+    assert calls[0] == len(indices) and 0 < calls[1] < len(indices)
+    expected = buffer.get_batch(len(indices), 3, 2, 0.9, indices)
+    for part, expected_part in zip(batch.s + batch.s_, expected.s + expected.s_):
+        np.testing.assert_array_equal(part, expected_part)
+    for name in ("a", "r", "done"):
+        np.testing.assert_array_equal(getattr(batch, name), getattr(expected, name))
+
+
+def test_lock_free_checks_every_segment_of_the_window():
+    """ window of idx 33 reads slots 31..33, 0, 1 of segments 1, 2 and 0,
+        a write of the short last segment in the middle tears it
+    """
+    buffer = ServerBuffer(34, OBS_SHAPES, ACTION_SIZE, lock_free=True, segment_size=16)
+    fill(buffer, [20, 14])
+    gather = buffer._gather_batch
+    calls = []
+
+    def gather_during_write(*args, **kwargs):
+        batch = gather(*args, **kwargs)
+        if not calls:
+            buffer._segment_seqs[2] += 2
+        calls.append(list(args[4]))
+        return batch
+
+    buffer._gather_batch = gather_during_write
+    buffer.get_batch(2, 3, 2, 0.9, np.array([33, 5]))
+    assert calls == [[33, 5], [33]]
+
+
+def test_lock_free_batches_are_consistent_with_concurrent_writer():
+    """ observation of every sampled transition is from the same
+        episode as its reward, although the writer never waits for samplers
+    """
+    buffer = ServerBuffer(256, [(64, )], 1, lock_free=True, segment_size=32)
+
+    def constant_episode(value, length=40):
+        return [[np.full((length, 64), value, dtype=np.float32)],
+                np.full((length, 1), value, dtype=np.float32),
+                np.full(length, value, dtype=np.float32),
+                np.zeros(length, dtype=bool)]
+
+    buffer.push_episode(constant_episode(0., 256))
+    stop = threading.Event()
+
+    def write():
+        value = 1.
+        while not stop.is_set():
+            buffer.push_episode(constant_episode(value))
+            value += 1.
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(300):
+            batch = buffer.get_batch(32)
+            np.testing.assert_array_equal(batch.s[0][:, -1, :].min(axis=1), batch.r)
+            np.testing.assert_array_equal(batch.s[0][:, -1, :].max(axis=1), batch.r)
+    finally:
+        stop.set()
+        writer.join()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_snapshot_round_trip(tmpdir, compress):
+    buffer = ServerBuffer(100, OBS_SHAPES, ACTION_SIZE, prioritized=True)
+    buffer.register_n_step(3, 0.9)
+    fill(buffer, [40, 35, 50])
+    indices = np.arange(buffer.num_in_buffer)
+    buffer.update_td_errors(indices[:10], np.arange(10, dtype=np.float32) + 5.)
+    path = str(tmpdir.join("buffer.bin"))
+    buffer.save(path, compress=compress, chunk_size=32)
+    assert not os.path.exists(path + ".tmp")
+
+    loaded = ServerBuffer(100, OBS_SHAPES, ACTION_SIZE, prioritized=True)
+    loaded.register_n_step(3, 0.9)
+    loaded.load(path, verbose=False)
+    assert (loaded.pointer, loaded.num_in_buffer, loaded.stored_in_buffer) == \
+        (buffer.pointer, buffer.num_in_buffer, buffer.stored_in_buffer)
+    for (name, array), (_, loaded_array) in zip(buffer._stored_arrays(), loaded._stored_arrays()):
+        np.testing.assert_array_equal(array, loaded_array, err_msg=name)
+    for array, loaded_array in zip(buffer.register_n_step(3, 0.9), loaded.register_n_step(3, 0.9)):
+        np.testing.assert_array_equal(array, loaded_array)
+    np.testing.assert_allclose(loaded._sum_tree[indices], buffer._sum_tree[indices], rtol=1e-5)
+    assert loaded._max_priority == pytest.approx(buffer._max_priority)
+
+
+def test_snapshot_with_concurrent_pushes(tmpdir):
+    """ episodes pushed while the chunks are written end up in the snapshot
+        as the buffer is at the end of the save, not half old and half new
+    """
+    buffer = ServerBuffer(100, OBS_SHAPES, ACTION_SIZE)
+    fill(buffer, [40, 35, 25])
+    write_chunks = buffer._write_chunks
+    pushed = [0]
+
+    def write_chunks_during_pushes(f, chunks, compress):
+        write_chunks(f, chunks, compress)
+        if pushed[0] < 3:
+            # each of them crosses a chunk boundary
+            buffer.push_episode(make_episode(30, 1000 + 30 * pushed[0]))
+            pushed[0] += 1
+
+    buffer._write_chunks = write_chunks_during_pushes
+    path = str(tmpdir.join("buffer.bin"))
+    buffer.save(path, chunk_size=16)
+    buffer._write_chunks = write_chunks
+    assert pushed[0] == 3
+
+    loaded = ServerBuffer(100, OBS_SHAPES, ACTION_SIZE)
+    loaded.load(path, verbose=False)
+    assert (loaded.pointer, loaded.num_in_buffer, loaded.stored_in_buffer) == \
+        (buffer.pointer, buffer.num_in_buffer, buffer.stored_in_buffer)
+    for (name, array), (_, loaded_array) in zip(buffer._stored_arrays(), loaded._stored_arrays()):
+        np.testing.assert_array_equal(array, loaded_array, err_msg=name)
+
+
+def test_load_rejects_other_buffer(tmpdir):
+    buffer = ServerBuffer(100, OBS_SHAPES, ACTION_SIZE)
+    fill(buffer, [10])
+    path = str(tmpdir.join("buffer.bin"))
+    buffer.save(path)
+    with pytest.raises(ValueError):
+        ServerBuffer(100, [(3, )], ACTION_SIZE).load(path)
+
+
+@pytest.mark.parametrize("priority", ["proportional", "rank"])
+def test_importance_weights_are_normalized_over_buffer(priority):
+    buffer = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE, prioritized=True, alpha=0.7)
+    fill(buffer, [32, 32])
+    indices = np.arange(64)
+    td_errors = np.linspace(0.1, 10., 64).astype(np.float32)
+    buffer.update_td_errors(indices, td_errors)
+
+    beta = 0.5
+    _, sampled, is_weights, _ = buffer.get_prioritized_batch(
+        16, priority=priority, beta=beta)
+    assert np.all(is_weights <= 1. + 1e-6)
+    if priority == "proportional":
+        priorities = (np.abs(td_errors) + 1e-6) ** buffer.alpha
+        expected = np.power(priorities[sampled] / priorities.min(), -beta)
+        np.testing.assert_allclose(is_weights, expected, rtol=1e-5)
+
+
+def test_rank_based_new_slots_take_top_ranks():
+    buffer = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE, prioritized=True)
+    fill(buffer, [40])
+    buffer.update_td_errors(np.arange(40), np.linspace(10., 0.1, 40).astype(np.float32))
+    buffer.get_prioritized_batch(8, priority="rank")
+    # new slots and the overwritten ones until the next sort
+    buffer.push_episode(make_episode(30, 100))
+    _, sampled, _, _ = buffer.get_prioritized_batch(8, priority="rank")
+    new = np.arange(40, 70) % 64
+    assert set(buffer._ranked[:30]) == set(new)
+    assert sorted(buffer._ranked) == list(range(64))
+    assert sampled[0] in new
+
+
+def test_stale_td_errors_are_dropped():
+    buffer = ServerBuffer(32, OBS_SHAPES, ACTION_SIZE, prioritized=True)
+    fill(buffer, [32])
+    _, indices, _, generations = buffer.get_prioritized_batch(8)
+    fill(buffer, [32])
+    max_priority = buffer._max_priority
+    buffer.update_td_errors(indices, np.full(8, 100., dtype=np.float32), generations)
+    assert buffer.stale_td_updates == 8
+    assert buffer._max_priority == max_priority
+
+
+def test_get_batches_do_not_share_arrays():
+    buffer = ServerBuffer(64, OBS_SHAPES, ACTION_SIZE)
+    fill(buffer, [64])
+    buffer.register_batch_buffers(8, num_buffers=2)
+    batches = buffer.get_batches(4, 8)
+    assert len({id(batch.r) for batch in batches}) == 4
+    # pooled buffers are still used when there are enough of them
+    pooled = buffer.get_batches(2, 8)
+    assert pooled[0].r is not pooled[1].r
@@ -0,0 +1,95 @@
+import os
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip("multiprocessing.shared_memory")
+
+from rl_server.server.shared_replay_buffer import SharedServerBuffer
+
+
+OBS_SHAPES = [(3, )]
+ACTION_SIZE = 2
+_names = itertools.count()
+
+
+def make_episode(length, value=0.):
+    dones = np.zeros(length, dtype=bool)
+    dones[-1] = True
+    return [
+        [np.full((length, 3), value, dtype=np.float32)],
+        np.zeros((length, ACTION_SIZE), dtype=np.float32),
+        np.full(length, value, dtype=np.float32),
+        dones]
+
+
+@pytest.fixture
+def writer():
+    name = "tars_test_{}_{}".format(os.getpid(), next(_names))
+    buffer = SharedServerBuffer(name, 20, OBS_SHAPES, ACTION_SIZE)
+    buffer.register_n_step(1, 0.99)
+    yield buffer
+    buffer.close()
+    if os.path.isdir("/dev/shm"):
+        assert not [f for f in os.listdir("/dev/shm") if f.startswith(name)]
+
+
+def attach(writer, **kwargs):
+    return SharedServerBuffer(writer.name, 20, OBS_SHAPES, ACTION_SIZE, create=False, **kwargs)
+
+
+def test_sampler_sees_published_episodes(writer):
+    sampler = attach(writer)
+    writer.push_episode(make_episode(8, 1.))
+    assert sampler.get_stored_in_buffer() == 8
+    batch = sampler.get_batch(4)
+    np.testing.assert_array_equal(batch.r, np.ones(4))
+    sampler.close()
+
+
+def test_load_is_published_to_samplers(writer, tmpdir):
+    writer.push_episode(make_episode(12, 2.))
+    path = str(tmpdir.join("buffer.bin"))
+    writer.save(path)
+
+    name = writer.name + "_loaded"
+    loaded = SharedServerBuffer(name, 20, OBS_SHAPES, ACTION_SIZE)
+    try:
+        loaded.load(path, verbose=False)
+        sampler = SharedServerBuffer(name, 20, OBS_SHAPES, ACTION_SIZE, create=False)
+        assert sampler.get_stored_in_buffer() == 12
+        sampler.close()
+    finally:
+        loaded.close()
+
+
+def test_stale_td_errors_are_dropped_by_sampler(writer):
+    sampler = attach(writer, prioritized=True)
+    writer.push_episode(make_episode(10, 1.))
+    _, indices, _, generations = sampler.get_prioritized_batch(4)
+    sampler.update_td_errors(indices, np.full(4, 5., dtype=np.float32), generations)
+
+    # the whole ring is overwritten before the next td errors arrive
+    writer.push_episode(make_episode(20, 2.))
+    max_priority = sampler._max_priority
+    sampler.update_td_errors(indices, np.full(4, 100., dtype=np.float32), generations)
+    assert sampler.stale_td_updates == 4
+    assert sampler._max_priority == max_priority
+    sampler.close()
+
+
+def test_restarted_sampler_keeps_priorities(writer):
+    sampler = attach(writer, prioritized=True)
+    writer.push_episode(make_episode(20, 1.))
+    sampler.get_prioritized_batch(4)
+    indices = np.array([0, 1])
+    sampler.update_td_errors(
+        indices, np.array([7., 7.], dtype=np.float32), sampler.generations[indices].copy())
+    sampler.close()
+
+    restarted = attach(writer, prioritized=True)
+    restarted.get_prioritized_batch(4)
+    np.testing.assert_allclose(
+        restarted._sum_tree[indices], (7. + 1e-6) ** restarted.alpha, rtol=1e-6)
+    restarted.close()